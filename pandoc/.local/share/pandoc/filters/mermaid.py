@@ -7,6 +7,9 @@
 # This file is distributed under the BSD 3-Clause License.
 # See https://github.com/jgm/pandocfilters/blob/master/LICENSE for details.
 # 
+# Change 2026-10-18:
+#   - render all uncached diagrams of a document with one mmdc call
+#   - render batches in parallel
 
 """
 Mermaid filter to process code blocks with class "mermaid" into
@@ -15,17 +18,27 @@ mermaid-generated images.
 Needs the ``mmdc`` command provided by `mermaid-cli
 <https://github.com/mermaid-js/mermaid-cli>`_ to be in the PATH and
 executable.
+
+Diagrams that are not cached yet are collected while walking the document,
+and rendered together afterwards, with the markdown mode of ``mmdc``. That way,
+the browser only starts once.
 """
 
 import os
-import sys
 
-from subprocess import call
-from typing import Optional
+from pathlib import Path
+from shutil import move
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional
+
+from pandocfilters import Para, Image, get_caption, get_extension
 
-from pandocfilters import toJSONFilter, Para, Image, get_caption, get_extension
+from utils import (
+    RenderEngine, get_cache_dir, get_tmpdir_info, get_default_image_filetype, run_command, to_json_filter_batched,
+)
 
-from utils import get_cache_dir, get_tmpdir_info, get_default_image_filetype
+# sources of the diagrams to render, by output file type and content hash
+pending: Dict[str, Dict[str, Path]] = {}
 
 
 def mermaid(key: str, value: str, format: str, meta: dict) -> Optional:
@@ -47,19 +60,76 @@ def mermaid(key: str, value: str, format: str, meta: dict) -> Optional:
                 with open(src, "w") as f:
                     f.write(code)
 
-                format_options = ["--outputFormat", filetype]
-                if filetype == "pdf":
-                    format_options.append("--pdfFit")
-
-                call(["mmdc", "--input", src, "--output", dest, *format_options, "--quiet"])
-                sys.stderr.write("Created image " + dest + "\n")
+                # rendered by render_pending, once the whole document was walked
+                pending.setdefault(filetype, {}).setdefault(filehash, src)
 
             caption, typef, keyvals = get_caption(keyvals)
             return Para([Image([ident, [], keyvals], caption, [dest, typef])])
 
 
+def get_format_options(filetype: str) -> List[str]:
+    format_options = ["--outputFormat", filetype]
+    if filetype == "pdf":
+        format_options.append("--pdfFit")
+    return format_options
+
+
+def render_pending(engine: RenderEngine) -> None:
+    """
+    Queue up the renders of the diagrams collected by `mermaid`, in batches of
+    diagrams that are rendered with one ``mmdc`` call each.
+    """
+    cache = get_cache_dir() / "mermaid"
+    for filetype, sources in pending.items():
+        batch = []
+        for filehash, src in sources.items():
+            code = src.read_text()
+            if "```" in code:
+                # would end the fence early, so render it on its own
+                engine.submit(render_single, filetype, filehash, src, cache)
+            else:
+                batch.append((filehash, code))
+
+        for part in engine.batches(batch):
+            engine.submit(render_batch, filetype, dict(part), cache)
+    pending.clear()
+
+
+def render_single(filetype: str, filehash: str, src: Path, cache: Path) -> str:
+    """Render one diagram, and return the log."""
+    dest = cache / f"{filehash}.{filetype}"
+    log = run_command(["mmdc", "--input", src, "--output", dest, *get_format_options(filetype), "--quiet"])
+    return log + "Created image " + str(dest) + "\n"
+
+
+def render_batch(filetype: str, codes: Dict[str, str], cache: Path) -> str:
+    """
+    Render diagrams with one ``mmdc`` call, and return the log. The diagrams
+    are put into a markdown file in document order, for which ``mmdc`` writes
+    the images ``out-1``, ``out-2`` and so on.
+    """
+    with TemporaryDirectory(prefix="mermaid") as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        with open(tmp_dir / "diagrams.md", "w") as f:
+            for code in codes.values():
+                f.write(f"```mermaid\n{code.rstrip()}\n```\n\n")
+
+        log = run_command(["mmdc", "--input", tmp_dir / "diagrams.md", "--output", tmp_dir / "out.md",
+                           *get_format_options(filetype), "--quiet"])
+
+        for i, filehash in enumerate(codes, start=1):
+            image = tmp_dir / f"out-{i}.{filetype}"
+            dest = cache / f"{filehash}.{filetype}"
+            if image.is_file():
+                move(image, dest)
+                log += "Created image " + str(dest) + "\n"
+            else:
+                log += "Failed to create image " + str(dest) + "\n"
+    return log
+
+
 if __name__ == "__main__":
-    toJSONFilter(mermaid)
+    to_json_filter_batched(mermaid, render_pending)
     # from filter_debug_utils import run_dbg_filter
     # output = run_dbg_filter(mermaid, "test.md")
     # print(output)
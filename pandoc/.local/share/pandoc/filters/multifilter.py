@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2026, Fynn Freyer
+# All rights reserved.
+#
+# This file is distributed under the BSD 3-Clause License.
+# See https://github.com/jgm/pandocfilters/blob/master/LICENSE for details.
+#
+
+"""
+Pandoc filter that runs several Python filters in one process, with one walk
+over the document, instead of one process that parses and serializes the whole
+document for every filter.
+
+The filters to run are listed in the ``multifilter`` metadata field, in the
+order they should be applied, e.g. in a defaults file::
+
+    filters:
+      - ${.}/../filters/multifilter.py
+    metadata:
+      multifilter:
+        - plantuml
+        - mermaid
+
+Every entry names a module next to this file, and optionally the action in it
+(``module:function``). The action defaults to the function named like the
+module. If the module has a ``render_pending`` function, it is called after the
+walk, to queue up the renders the action collected, and all of them are run by
+one `RenderEngine`.
+"""
+
+import io
+import json
+import sys
+
+from importlib import import_module
+from typing import Callable, List, Optional
+
+from pandocfilters import walk
+
+from utils import RenderEngine, get_meta_value
+
+
+def load_filters(names: List[str]) -> List[tuple]:
+    """
+    Import the filters listed in the metadata.
+
+    :param names: Entries of the form ``module`` or ``module:function``.
+    :return: Tuples of the action and the ``render_pending`` function (or None) of every filter.
+    """
+    filters = []
+    for name in names:
+        module_name, _, action_name = name.partition(":")
+        module = import_module(module_name)
+        action = getattr(module, action_name or module_name)
+        filters.append((action, getattr(module, "render_pending", None)))
+    return filters
+
+
+def fuse(actions: List[Callable]) -> Callable:
+    """
+    Combine filter actions into one, that applies them to an element in order.
+    Every action sees what the previous ones made of the element, like it would
+    when running the filters one after the other.
+    """
+    def fused(key: str, value, format: str, meta: dict) -> Optional[list]:
+        elements = [{"t": key, "c": value} if value is not None else {"t": key}]
+        changed = False
+        for action in actions:
+            results = []
+            for element in elements:
+                result = action(element["t"], element.get("c"), format, meta)
+                if result is None:
+                    results.append(element)
+                else:
+                    results.extend(result if isinstance(result, list) else [result])
+                    changed = True
+            elements = results
+        return elements if changed else None
+
+    return fused
+
+
+def multifilter(source: str, format: str, engine: Optional[RenderEngine] = None) -> str:
+    """
+    Apply the filters listed in the metadata of a document.
+
+    :param source: The document, as JSON.
+    :param format: The output format.
+    :param engine: The engine to run the renders with. A new one is used if not set.
+    :return: The filtered document, as JSON.
+    """
+    engine = engine if engine is not None else RenderEngine()
+    doc = json.loads(source)
+    meta = doc.get("meta", {})
+    names = get_meta_value(meta, "multifilter", [])
+    filters = load_filters([names] if isinstance(names, str) else names)
+
+    doc = walk(doc, fuse([action for action, _ in filters]), format, meta)
+    for _, render_pending in filters:
+        if render_pending is not None:
+            render_pending(engine)
+    engine.run()
+
+    return json.dumps(doc)
+
+
+if __name__ == "__main__":
+    input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+    sys.stdout.write(multifilter(input_stream.read(), sys.argv[1] if len(sys.argv) > 1 else ""))
@@ -14,27 +14,47 @@
 #   - register more classes for plantuml code
 # Change 2023-12-17:
 #   - extract shared functionality to separate utils module
+# Change 2026-10-18:
+#   - render all uncached diagrams of a document with one plantuml call
+#   - optionally render through a long-lived server, see plantuml_server.py
+#   - render batches in parallel
 
 """
 Pandoc filter to process code blocks with class "plantuml" into
 plant-generated images.
 
 Needs a ``plantuml`` command to be in the PATH and executable.
+
+Diagrams that are not cached yet are collected while walking the document,
+and rendered together afterwards, so the JVM only starts once. With the
+``plantuml-server`` metadata field set to true, they are rendered by a server
+that keeps running between pandoc runs instead (see ``plantuml_server.py``),
+so the JVM doesn't need to start at all.
 """
 
 import os
-import sys
 
+from pathlib import Path
 from shutil import which
-from subprocess import call
-from typing import Optional
+from typing import Dict, Optional
+
+from pandocfilters import Para, Image, get_caption, get_extension
 
-from pandocfilters import toJSONFilter, Para, Image, get_caption, get_extension
+from plantuml_server import PlantUMLClient
+from utils import (
+    RenderEngine, get_cache_dir, get_tmpdir_info, get_default_image_filetype, get_meta_value, run_command,
+    to_json_filter_batched,
+)
 
-from utils import get_cache_dir, get_tmpdir_info, get_default_image_filetype
+# sources of the diagrams to render, by output file type and content hash
+pending: Dict[str, Dict[str, Path]] = {}
+# whether to render through the render server
+use_server = False
 
 
 def plantuml(key: str, value: str, format: str, meta: dict) -> Optional:
+    global use_server
+
     if key == "CodeBlock":
         [[ident, classes, keyvals], code] = value
 
@@ -58,15 +78,68 @@ def plantuml(key: str, value: str, format: str, meta: dict) -> Optional:
                 with open(src, "w") as f:
                     f.write(code)
 
-                call(["plantuml", f"-t{filetype}", "-output", cache, src])
-                sys.stderr.write("Created image " + dest + "\n")
+                # rendered by render_pending, once the whole document was walked
+                pending.setdefault(filetype, {}).setdefault(filehash, src)
+                use_server = bool(get_meta_value(meta, "plantuml-server", False))
 
             caption, typef, keyvals = get_caption(keyvals)
             return Para([Image([ident, [], keyvals], caption, [dest, typef])])
 
 
+def render_pending(engine: RenderEngine) -> None:
+    """
+    Queue up the renders of the diagrams collected by `plantuml`, in batches of
+    diagrams that are rendered with one ``plantuml`` call each.
+    """
+    cache = get_cache_dir() / "plantuml"
+    for filetype, sources in pending.items():
+        if use_server:
+            engine.submit(render_with_server, filetype, sources, cache)
+        else:
+            for batch in engine.batches(list(sources.items())):
+                engine.submit(render_batch, filetype, dict(batch), cache)
+    pending.clear()
+
+
+def render_batch(filetype: str, sources: Dict[str, Path], cache: Path) -> str:
+    """Render diagrams with one ``plantuml`` call, and return the log."""
+    log = run_command(["plantuml", f"-t{filetype}", "-output", cache, *sources.values()])
+    for filehash in sources:
+        log += "Created image " + str(cache / f"{filehash}.{filetype}") + "\n"
+    return log
+
+
+def render_with_server(filetype: str, sources: Dict[str, Path], cache: Path) -> str:
+    """
+    Render diagrams through the render server, and return the log. Diagrams it
+    fails to render are rendered by `render_batch`.
+    """
+    log = ""
+    remaining = dict(sources)
+    try:
+        with PlantUMLClient() as client:
+            for filehash, src in sources.items():
+                try:
+                    image = client.render(src.read_text(), filetype)
+                except RuntimeError:
+                    continue
+
+                dest = cache / f"{filehash}.{filetype}"
+                tmp_dest = dest.with_name(f".{dest.name}.{os.getpid()}")
+                tmp_dest.write_bytes(image)
+                tmp_dest.replace(dest)
+                del remaining[filehash]
+                log += "Created image " + str(dest) + "\n"
+    except (OSError, EOFError) as e:
+        log += f"PlantUML server unavailable, rendering without it: {e}\n"
+
+    if remaining:
+        log += render_batch(filetype, remaining, cache)
+    return log
+
+
 if __name__ == "__main__":
-    toJSONFilter(plantuml)
+    to_json_filter_batched(plantuml, render_pending)
     # from filter_debug_utils import run_dbg_filter
     # output = run_dbg_filter(plantuml, "test.md")
     # print(output)
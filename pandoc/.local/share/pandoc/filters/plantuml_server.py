@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2026, Fynn Freyer
+# All rights reserved.
+#
+# This file is distributed under the BSD 3-Clause License.
+# See https://github.com/jgm/pandocfilters/blob/master/LICENSE for details.
+#
+
+"""
+Render server for the plantuml filter, that keeps PlantUML running between
+pandoc runs, so diagrams render without waiting for the JVM to start.
+
+The server listens on a unix socket, and drives one ``plantuml -pipe`` process
+per output file type. It is started by `PlantUMLClient` on first use, and shuts
+itself down after being idle for a while. Servers starting and stopping hold a
+lock file next to the socket, so runs started together share one server.
+
+Every request is a JSON header line with the file type and the length of the
+diagram source, followed by the source. Every response is a JSON header line
+with the length of the image, followed by the image, or a header with an error.
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+from signal import SIGTERM, signal
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Lock, Thread
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple
+from uuid import uuid4
+
+from utils import get_cache_dir
+
+IDLE_TIMEOUT = 15 * 60
+
+
+def get_socket_path() -> Path:
+    """Where the render server listens."""
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / "pandoc-plantuml.sock"
+    return get_cache_dir() / "plantuml.sock"
+
+
+@contextmanager
+def socket_lock(path: Path) -> Iterator[None]:
+    """Hold the lock for binding or removing the socket at `path`, waiting for other servers to release it."""
+    # only the server needs it, and it only runs where unix sockets do
+    import fcntl
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.with_name(path.name + ".lock").open("a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def remove_socket(path: Path, inode: int) -> None:
+    """Remove the socket of a server, unless another server has replaced it already."""
+    with socket_lock(path):
+        try:
+            if path.stat().st_ino == inode:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def write_message(stream: BinaryIO, header: dict, data: bytes = b"") -> None:
+    stream.write(json.dumps({**header, "length": len(data)}).encode() + b"\n" + data)
+    stream.flush()
+
+
+def read_message(stream: BinaryIO) -> Tuple[dict, bytes]:
+    line = stream.readline()
+    if not line:
+        raise EOFError("connection closed")
+    header = json.loads(line)
+    data = stream.read(header["length"])
+    if len(data) < header["length"]:
+        raise EOFError("connection closed")
+    return header, data
+
+
+class PlantUMLPipe:
+    """A ``plantuml -pipe`` process, rendering one diagram after the other."""
+
+    def __init__(self, filetype: str):
+        self.filetype = filetype
+        self.delimiter = f"--{uuid4().hex}--".encode()
+        self.lock = Lock()
+        self.process: Optional[Popen] = None
+
+    def render(self, source: bytes) -> bytes:
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.process = Popen(
+                    ["plantuml", "-pipe", f"-t{self.filetype}", "-charset", "UTF-8",
+                     "-pipedelimitor", self.delimiter.decode()],
+                    stdin=PIPE, stdout=PIPE, stderr=DEVNULL,
+                )
+            self.process.stdin.write(source.rstrip(b"\n") + b"\n")
+            self.process.stdin.flush()
+
+            # the image is followed by the delimiter on a line of its own
+            output = b""
+            while not output.endswith(self.delimiter + b"\n"):
+                chunk = self.process.stdout.read1(1 << 16)
+                if not chunk:
+                    self.process = None
+                    raise RuntimeError("plantuml exited while rendering")
+                output += chunk
+            return output[:-len(self.delimiter) - 1]
+
+    def close(self) -> None:
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait()
+
+
+class PlantUMLServer(ThreadingUnixStreamServer):
+    """Serves render requests from a unix socket, until it was idle for `idle_timeout` seconds."""
+
+    daemon_threads = True
+
+    def __init__(self, path: Path, idle_timeout: float = IDLE_TIMEOUT):
+        self.path = path
+        self.pipes: Dict[str, PlantUMLPipe] = {}
+        self.pipes_lock = Lock()
+        self.idle_timeout = idle_timeout
+        self.last_used = time.monotonic()
+        self.connections = 0
+        self.connections_lock = Lock()
+        super().__init__(str(path), RenderHandler)
+        self.inode = path.stat().st_ino
+
+    def pipe(self, filetype: str) -> PlantUMLPipe:
+        with self.pipes_lock:
+            if filetype not in self.pipes:
+                self.pipes[filetype] = PlantUMLPipe(filetype)
+            return self.pipes[filetype]
+
+    def watch_idle(self) -> None:
+        while True:
+            time.sleep(min(self.idle_timeout, 10))
+            if not self.connections and time.monotonic() - self.last_used > self.idle_timeout:
+                # no new clients from here on, a server started meanwhile binds a new socket
+                remove_socket(self.path, self.inode)
+                self.shutdown()
+                return
+
+    def server_close(self) -> None:
+        super().server_close()
+        for pipe in self.pipes.values():
+            pipe.close()
+
+
+class RenderHandler(StreamRequestHandler):
+    server: PlantUMLServer
+
+    def handle(self) -> None:
+        with self.server.connections_lock:
+            self.server.connections += 1
+        try:
+            while True:
+                try:
+                    header, source = read_message(self.rfile)
+                except EOFError:
+                    return
+                try:
+                    image = self.server.pipe(header["filetype"]).render(source)
+                except Exception as e:
+                    write_message(self.wfile, {"error": str(e)})
+                else:
+                    write_message(self.wfile, {}, image)
+                self.server.last_used = time.monotonic()
+        finally:
+            with self.server.connections_lock:
+                self.server.connections -= 1
+            self.server.last_used = time.monotonic()
+
+
+class PlantUMLClient:
+    """Connection to the render server, which is started if it isn't running yet."""
+
+    def __init__(self, path: Optional[Path] = None, start_timeout: float = 10):
+        """
+        :param path: The socket of the server. Defaults to `get_socket_path`.
+        :param start_timeout: How many seconds to wait for the server to start.
+        :raise OSError: If the server could not be reached.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise OSError("unix sockets are not supported on this platform")
+        self.path = path if path is not None else get_socket_path()
+        try:
+            self.socket = self._connect()
+        except (FileNotFoundError, ConnectionRefusedError):
+            self.socket = self._start(start_timeout)
+        self.stream = self.socket.makefile("rwb")
+
+    def render(self, source: str, filetype: str) -> bytes:
+        """
+        Render a diagram.
+
+        :param source: The diagram, including ``@start`` and ``@end`` directives.
+        :param filetype: The image type, as passed to ``plantuml -t``.
+        :return: The image.
+        :raise RuntimeError: If PlantUML failed to render the diagram.
+        """
+        write_message(self.stream, {"filetype": filetype}, source.encode())
+        header, image = read_message(self.stream)
+        if "error" in header:
+            raise RuntimeError(header["error"])
+        return image
+
+    def close(self) -> None:
+        self.stream.close()
+        self.socket.close()
+
+    def __enter__(self) -> "PlantUMLClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _connect(self) -> socket.socket:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(str(self.path))
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def _start(self, timeout: float) -> socket.socket:
+        # in a new session, so the server outlives pandoc
+        Popen([sys.executable, __file__, "--socket", str(self.path)],
+              stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self._connect()
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+
+def serve(path: Path, idle_timeout: float = IDLE_TIMEOUT) -> None:
+    """Run the render server, until it is idle for `idle_timeout` seconds."""
+    # checking for a running server and binding the socket has to happen in one go
+    with socket_lock(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+            # another server was faster
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            path.unlink(missing_ok=True)
+        finally:
+            probe.close()
+        server = PlantUMLServer(path, idle_timeout)
+
+    # clean up the socket when killed, too
+    signal(SIGTERM, lambda *_: sys.exit())
+    with server:
+        Thread(target=server.watch_idle, daemon=True).start()
+        try:
+            server.serve_forever()
+        finally:
+            remove_socket(path, server.inode)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--socket", type=Path, default=get_socket_path(), help="where to listen")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds without requests after which the server exits")
+    args = parser.parse_args()
+    serve(args.socket, args.idle_timeout)
@@ -1,12 +1,16 @@
+import io
 import os
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
 from pathlib import Path
 from platform import system
 from shutil import which
-from typing import Tuple, Literal
+from subprocess import DEVNULL, PIPE, STDOUT, run
+from typing import Any, Callable, List, Optional, Sequence, Tuple, Literal, TypeVar
 
-from pandocfilters import get_filename4code
+from pandocfilters import applyJSONFilters, get_filename4code, stringify
 
 
 def get_cache_dir() -> Path:
@@ -44,7 +48,121 @@ def get_tmpdir_info(prefix: str, code: str) -> Tuple[Path, str]:
     return tmp_dir, filehash
 
 
+def get_meta_value(meta: dict, key: str, default: Any = None) -> Any:
+    """
+    Get a metadata field of a document as a plain Python value.
+
+    :param meta: The metadata of the document, as passed to filter actions.
+    :param key: The name of the field.
+    :param default: Returned if the field isn't set.
+    :return: A bool, string, list or dict, depending on the field.
+    """
+    def convert(value: dict) -> Any:
+        if value["t"] in ("MetaBool", "MetaString"):
+            return value["c"]
+        elif value["t"] == "MetaList":
+            return [convert(item) for item in value["c"]]
+        elif value["t"] == "MetaMap":
+            return {k: convert(v) for k, v in value["c"].items()}
+        return stringify(value["c"])
+
+    return convert(meta[key]) if key in meta else default
+
+
 def get_default_image_filetype() -> Literal["svg", "png"]:
     """If we can convert SVG files, we prefer them over raster images."""
     svg_converter = which("rsvg-convert")
     return "svg" if svg_converter else "png"
+
+
+T = TypeVar("T")
+
+
+class RenderEngine:
+    """
+    Runs the renders that filters queued up while walking a document, in
+    parallel once the walk is done.
+
+    A render is a function that calls an external program, and returns what
+    should be logged. The logs are written in the order the renders were
+    submitted, no matter which finishes first, so the output is the same on
+    every run.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        """
+        :param max_workers: How many renders to run at once. Defaults to the number of CPUs.
+        """
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count() or 1
+        self.renders: List[Tuple[Callable[..., str], tuple]] = []
+
+    def submit(self, render: Callable[..., str], *args) -> None:
+        """Queue up a render, to be called with `args` by `run`."""
+        self.renders.append((render, args))
+
+    def batches(self, items: Sequence[T], min_size: int = 8) -> List[Sequence[T]]:
+        """
+        Split items that can be rendered by one program call into batches, one
+        per worker at most. Every batch pays the startup of the program, so
+        batches are only split if every part gets at least `min_size` items.
+        """
+        count = max(1, min(self.max_workers, len(items) // min_size))
+        size = max(1, ceil(len(items) / count))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def run(self) -> None:
+        """
+        Run the queued renders, and wait for all of them to finish.
+
+        :raise Exception: The first error of a render, after all of them finished.
+        """
+        renders, self.renders = self.renders, []
+        if not renders:
+            return
+
+        # the work happens in the called programs, so threads are enough to wait on them
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(render, *args) for render, args in renders]
+
+        errors = []
+        for future in futures:
+            try:
+                sys.stderr.write(future.result())
+            except Exception as e:
+                sys.stderr.write(f"Render failed: {e}\n")
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+def run_command(args: List[Any]) -> str:
+    """
+    Run a program to completion, and return its output (stdout and stderr), so
+    it can be logged in order. Its output must not end up on stdout, where
+    pandoc expects the document.
+    """
+    result = run([str(arg) for arg in args], stdin=DEVNULL, stdout=PIPE, stderr=STDOUT)
+    return result.stdout.decode(errors="replace")
+
+
+def to_json_filter_batched(action: Callable,
+                           flush: Callable[[RenderEngine], None],
+                           engine: Optional[RenderEngine] = None) -> None:
+    """
+    Like ``pandocfilters.toJSONFilter``, but call `flush` once the whole document
+    was walked, before it is written back to pandoc. This lets the action
+    collect work, like rendering images, that `flush` queues up in batches on a
+    `RenderEngine`. The renders are done before the document is written.
+
+    :param action: The filter action, see ``pandocfilters.walk``.
+    :param flush: Called with the engine, after `action` saw every element.
+    :param engine: The engine to run the renders with. A new one is used if not set.
+    """
+    engine = engine if engine is not None else RenderEngine()
+    input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+    format = sys.argv[1] if len(sys.argv) > 1 else ""
+
+    output = applyJSONFilters([action], input_stream.read(), format)
+    flush(engine)
+    engine.run()
+    sys.stdout.write(output)
@@ -3,15 +3,22 @@
 from sys import argv
 from fontforge import open as font_open
 
-ttf_file = argv[1]
-font = font_open(ttf_file)
 
 def clean(s):
     return s.replace("NF-", "-").replace("NF ", " ").replace(" Nerd Font", "")
 
-font.fontname = clean(font.fontname)
-font.familyname = clean(font.familyname)
-font.fullname = clean(font.fullname)
 
-font.generate(ttf_file)
+def clean_font(ttf_file):
+    """Remove the Nerd Font markers from the names of a font, in place."""
+    font = font_open(ttf_file)
 
+    font.fontname = clean(font.fontname)
+    font.familyname = clean(font.familyname)
+    font.fullname = clean(font.fullname)
+
+    font.generate(ttf_file)
+    font.close()
+
+
+if __name__ == '__main__':
+    clean_font(argv[1])
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""
+Benchmark ``setup.py`` without touching the machine it runs on.
+
+Every scenario runs the complete setup in a throwaway ``$HOME``, against synthetic assets:
+
+- Stand-ins for ``apt``, ``dpkg-query``, ``dnf``, ``rpm``, ``sudo``, ``git``, ``dconf``, ``gnome-extensions``,
+  ``kpackagetool5``, ``fc-cache`` and ``update-desktop-database`` are put in front of ``$PATH``, and fake ``pip`` and
+  ``fontforge`` modules in front of ``$PYTHONPATH``. They log their calls, and sleep for a configurable time, to
+  simulate the latency of the real tools.
+- A local HTTP server serves synthetic IDE tar balls, desktop extension archives and font archives.
+- The dotfile packages to stow are generated into a fake repo.
+
+The Mozilla step is skipped, because it needs Firefox and Thunderbird installed.
+
+Scenarios:
+
+- cold: empty download cache.
+- warm: download cache of the cold run, fresh ``$HOME``.
+- resume: ``$HOME`` of the warm run, with ``--resume``.
+
+For every scenario the wall time, the time of every setup step (taken from the trace of ``setup.py --trace``), and the
+number of calls to every stand-in are reported.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+
+from argparse import ArgumentParser
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from subprocess import DEVNULL, run
+from tarfile import TarInfo, open as taropen
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+from typing import Dict, List, Optional
+from zipfile import ZipFile
+
+SETUP_SCRIPT = Path(__file__).parent / 'setup.py'
+
+INFO = '\033[30\033[44m'
+RESET = '\033[0m'
+
+SCENARIOS = ('cold', 'warm', 'resume')
+
+# shims print canned output for the queries setup.py parses, everything else is only logged
+_shim_template = '''#!{python}
+import json, os, sys, time
+from pathlib import Path
+
+name, args = Path(sys.argv[0]).name, sys.argv[1:]
+with open(os.environ['BENCH_LOG'], 'a') as log:
+    log.write(json.dumps({{'cmd': name, 'args': args, 'time': time.time()}}) + '\\n')
+
+if name == 'sudo':
+    os.execvp(args[0], args)
+
+time.sleep(float(os.environ.get('BENCH_LATENCY_' + name.upper().replace('-', '_'), os.environ['BENCH_LATENCY'])))
+
+if name == 'git' and args[:1] == ['rev-parse']:
+    print(os.environ['BENCH_REPO'] if '--show-toplevel' in args else '0' * 40)
+elif name == 'pip' and '--report' in args:
+    # an empty resolution, the wheelhouse then has nothing to build
+    Path(args[args.index('--report') + 1]).write_text(json.dumps({{'install': []}}))
+elif name == 'dconf' and args[:1] == ['dump']:
+    state = Path(os.environ['HOME']) / '.bench-dconf'
+    print(state.read_text() if state.exists() else '')
+elif name == 'dconf' and args[:1] == ['load']:
+    with (Path(os.environ['HOME']) / '.bench-dconf').open('a') as state:
+        state.write(sys.stdin.read() + '\\n')
+'''
+
+SHIMS = ('apt', 'dpkg-query', 'dnf', 'rpm', 'sudo', 'git', 'dconf', 'gnome-extensions', 'kpackagetool5', 'fc-cache',
+         'update-desktop-database', 'pip')
+
+# stands in for the few parts of fontforge that clean_nerd_font.py uses, and takes some CPU time like the real thing
+_fontforge_module = '''import builtins, os, time
+
+
+class _Font:
+    def __init__(self, path):
+        with builtins.open(path, 'rb') as font_file:
+            self.data = font_file.read()
+        self.fontname = self.familyname = self.fullname = 'Bench Nerd Font'
+
+    def generate(self, path):
+        end = time.process_time() + float(os.environ.get('BENCH_LATENCY_FONTFORGE', os.environ['BENCH_LATENCY']))
+        while time.process_time() < end:
+            pass
+        with builtins.open(path, 'wb') as font_file:
+            font_file.write(self.data + self.fullname.encode())
+
+    def close(self):
+        pass
+
+
+def open(path):
+    return _Font(path)
+'''
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    """ Serve the mirror directory without logging every request. """
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def make_tarball(path: Path, top: str, files: Dict[str, bytes]) -> None:
+    """ Write a gzipped tar ball, with all `files` below a `top` level folder. """
+    with taropen(path, 'w:gz') as tarball:
+        for name, content in files.items():
+            member = TarInfo(f'{top}/{name}')
+            member.size = len(content)
+            member.mode = 0o755
+            tarball.addfile(member, BytesIO(content))
+
+
+def make_mirror(mirror: Path, url: str, ides: int, exts: int, size: int, fonts: int = 0, font_files: int = 0) \
+        -> Dict[str, list]:
+    """
+    Generate the artifacts to download into the `mirror` directory.
+
+    :param mirror: The directory served by the HTTP server.
+    :param url: The base URL of the server.
+    :param ides: Number of IDE tar balls.
+    :param exts: Number of GNOME and of KDE extension archives each.
+    :param size: Size of the payload of every IDE in bytes. Random, so it doesn't compress.
+    :param fonts: Number of font archives.
+    :param font_files: Number of font files in every font archive.
+    :return: Entries for the IDE file, and the URLs of the GNOME and KDE extensions and the font archives.
+    """
+    ide_list, gnome_exts, kde_exts, font_urls = [], [], [], []
+
+    for i in range(ides):
+        name = f'ide{i}'
+        make_tarball(mirror / f'{name}.tar.gz', f'{name}-1.0', {
+            f'bin/{name}': b'#!/bin/sh\n',
+            f'bin/{name}.svg': b'<svg/>',
+            'lib/payload.bin': os.urandom(size),
+        })
+        ide_list.append({'name': name, 'long_name': f'IDE {i}', 'url': f'{url}/{name}.tar.gz'})
+
+    for i in range(exts):
+        with ZipFile(mirror / f'gnome-ext{i}.zip', 'w') as archive:
+            archive.writestr('metadata.json', json.dumps({'uuid': f'ext{i}@bench'}))
+            archive.writestr('extension.js', os.urandom(64 * 1024).hex())
+        gnome_exts.append(f'{url}/gnome-ext{i}.zip')
+
+        make_tarball(mirror / f'kde-ext{i}.tar.gz', f'kde-ext{i}', {
+            'metadata.desktop': b'[Desktop Entry]\n',
+            'contents/code/main.js': os.urandom(64 * 1024),
+        })
+        kde_exts.append(f'{url}/kde-ext{i}.tar.gz')
+
+    for i in range(fonts):
+        with ZipFile(mirror / f'font{i}.zip', 'w') as archive:
+            archive.writestr('README.md', 'not a font')
+            for j in range(font_files):
+                archive.writestr(f'Font{i}NerdFont-Style{j}.ttf', os.urandom(256 * 1024))
+        font_urls.append(f'{url}/font{i}.zip')
+
+    return {'ides': ide_list, 'gnome': gnome_exts, 'kde': kde_exts, 'fonts': font_urls}
+
+
+def make_repo(repo: Path, pkgs: int, files: int) -> List[str]:
+    """ Generate dotfile packages to stow, each with `files` files spread over a few directories. """
+    names = []
+    for i in range(pkgs):
+        name = f'pkg{i}'
+        for j in range(files):
+            path = repo / name / f'.config/{name}/sub{j % 4}/file{j}'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(f'{name} {j}\n')
+        names.append(name)
+    return names
+
+
+def make_assets(assets: Path, mirror: Dict[str, list], stow_pkgs: List[str], sys_pkgs: int) -> None:
+    """ Write the package, IDE, stow and dconf files for `setup.py`. """
+    assets.mkdir(parents=True)
+    packages = {
+        'system': {'pkg': [f'sys-pkg{i}' for i in range(sys_pkgs)]},
+        'desktop': {
+            'gnome': {'pkg': ['gnome-pkg'], 'extensions': mirror['gnome']},
+            'kde': {'pkg': ['kde-pkg'], 'extensions': {'kwinscript': mirror['kde']}},
+        },
+        'pip': ['pip-pkg0', 'pip-pkg1'],
+    }
+    (assets / 'packages.json').write_text(json.dumps(packages, indent=2))
+    (assets / 'ides.json').write_text(json.dumps(mirror['ides'], indent=2))
+    (assets / 'stow.json').write_text(json.dumps(stow_pkgs, indent=2))
+    (assets / 'fonts.json').write_text(json.dumps(mirror['fonts'], indent=2))
+    (assets / 'gsettings.conf').write_text(''.join(
+        f'[org/bench/schema{i}]\nkey-a=true\nkey-b=uint32 {i}\nkey-c=\'value {i}\'\n\n' for i in range(40)
+    ))
+
+
+def make_shims(shims: Path) -> None:
+    """ Write the stand-in executables, and the fake ``pip`` and ``fontforge`` modules next to them. """
+    shims.mkdir(parents=True)
+    script = _shim_template.format(python=sys.executable)
+    for name in SHIMS:
+        shim = shims / name
+        shim.write_text(script)
+        shim.chmod(0o755)
+
+    pip_module = shims / 'pylib/pip'
+    pip_module.mkdir(parents=True)
+    (pip_module / '__init__.py').write_text('')
+    (pip_module / '__main__.py').write_text(
+        'import os, runpy, sys\n'
+        f'sys.argv[0] = {str(shims / "pip")!r}\n'
+        f'runpy.run_path({str(shims / "pip")!r}, run_name="__main__")\n'
+    )
+    (shims / 'pylib/fontforge.py').write_text(_fontforge_module)
+
+
+def run_scenario(scenario: str, work: Path, env: Dict[str, str], jobs: int) -> Dict[str, object]:
+    """
+    Run ``setup.py`` once.
+
+    :return: Wall time, per step timings, and the number of calls to every stand-in.
+    """
+    home = work / ('home-cold' if scenario == 'cold' else 'home-warm')
+    # empty, like on a fresh host, so steps creating the same directories concurrently are caught
+    home.mkdir(exist_ok=True)
+
+    log, trace = work / f'{scenario}.log', work / f'{scenario}.trace.json'
+    env = {**env, 'HOME': str(home), 'BENCH_LOG': str(log),
+           'XDG_STATE_HOME': str(home / '.local/state'), 'XDG_CACHE_HOME': str(work / 'cache')}
+    assets = work / 'assets'
+    command = [sys.executable, str(SETUP_SCRIPT),
+               '-p', str(assets / 'packages.json'), '-c', str(assets / 'gsettings.conf'),
+               '-s', str(assets / 'stow.json'), '-i', str(assets / 'ides.json'),
+               '--fonts', str(assets / 'fonts.json'),
+               '-j', str(jobs), '--skip', 'mozilla', '--trace', str(trace)]
+    if scenario == 'resume':
+        command.append('--resume')
+
+    start = perf_counter()
+    proc = run(command, env=env, stdin=DEVNULL, capture_output=True, text=True)
+    wall = perf_counter() - start
+    if proc.returncode != 0:
+        print(proc.stdout, proc.stderr, sep='\n')
+        raise RuntimeError(f'Scenario {scenario} failed with exit code {proc.returncode}')
+
+    steps = {}
+    with trace.open() as trace_file:
+        for span in json.load(trace_file)['traceEvents']:
+            if span['cat'] == 'step':
+                steps[span['name']] = span['dur'] / 1e6
+
+    calls = {}
+    if log.exists():
+        with log.open() as log_file:
+            for line in log_file:
+                cmd = json.loads(line)['cmd']
+                calls[cmd] = calls.get(cmd, 0) + 1
+
+    return {'wall': wall, 'steps': steps, 'calls': calls}
+
+
+def report(results: Dict[str, Dict[str, object]]) -> None:
+    """ Print a table of step timings per scenario, and the calls to the stand-ins. """
+    steps = sorted({step for result in results.values() for step in result['steps']})
+    cmds = sorted({cmd for result in results.values() for cmd in result['calls']})
+    width = max(len(name) for name in [*steps, *cmds, 'wall', 'calls'])
+
+    print(f'{INFO}{"":<{width}}' + ''.join(f'  {scenario:>8}' for scenario in results) + RESET)
+    for step in steps:
+        print(f'{step:<{width}}' + ''.join(
+            f'  {result["steps"][step]:7.2f}s' if step in result['steps'] else f'  {"-":>8}'
+            for result in results.values()
+        ))
+    print(f'{"wall":<{width}}' + ''.join(f'  {result["wall"]:7.2f}s' for result in results.values()))
+
+    print(f'{INFO}{"calls":<{width}}' + ''.join(f'  {scenario:>8}' for scenario in results) + RESET)
+    for cmd in cmds:
+        print(f'{cmd:<{width}}' + ''.join(f'  {result["calls"].get(cmd, 0):8d}' for result in results.values()))
+
+
+def parse_args(args: Optional[List[str]] = None):
+    parser = ArgumentParser(description='Benchmark setup.py in a throwaway home, against fake tools and a local mirror.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run, can be passed multiple times, defaults to all of them in order')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds every call to a stand-in takes')
+    parser.add_argument('--pkg-latency', type=float, default=2.0,
+                        help='seconds an install with the package manager or pip takes')
+    parser.add_argument('--ides', type=int, default=4, help='number of IDEs to install')
+    parser.add_argument('--ide-size', type=float, default=32, help='payload size of every IDE in MiB')
+    parser.add_argument('--extensions', type=int, default=4, help='number of GNOME and KDE extensions each')
+    parser.add_argument('--fonts', type=int, default=3, help='number of font archives')
+    parser.add_argument('--font-files', type=int, default=16, help='number of fonts in every font archive')
+    parser.add_argument('--stow-packages', type=int, default=13, help='number of dotfile packages to stow')
+    parser.add_argument('--stow-files', type=int, default=50, help='number of files in every dotfile package')
+    parser.add_argument('--sys-packages', type=int, default=60, help='number of system packages to install')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='passed on to setup.py')
+    parser.add_argument('--json', type=Path, metavar='PATH', help='also write the results as JSON')
+    return parser.parse_args(args)
+
+
+def main(args) -> Dict[str, Dict[str, object]]:
+    with TemporaryDirectory(prefix='setup-bench-') as tmp:
+        work = Path(tmp)
+        (work / 'mirror').mkdir()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(_QuietHandler, directory=str(work / 'mirror')))
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}'
+            mirror = make_mirror(work / 'mirror', url, args.ides, args.extensions, int(args.ide_size * 1024 ** 2),
+                                 args.fonts, args.font_files)
+            stow_pkgs = make_repo(work / 'repo', args.stow_packages, args.stow_files)
+            make_assets(work / 'assets', mirror, stow_pkgs, args.sys_packages)
+            make_shims(work / 'shims')
+
+            env = {
+                **os.environ,
+                'PATH': f'{work / "shims"}{os.pathsep}{os.environ.get("PATH", "")}',
+                'PYTHONPATH': str(work / 'shims/pylib'),
+                'XDG_CURRENT_DESKTOP': 'GNOME:KDE',
+                # setup.py refuses to install pip packages as root
+                'USER': 'bench',
+                'LOGNAME': 'bench',
+                'BENCH_REPO': str(work / 'repo'),
+                'BENCH_LATENCY': str(args.latency),
+                **{f'BENCH_LATENCY_{name}': str(args.pkg_latency) for name in ('APT', 'DNF', 'PIP')},
+            }
+
+            results = {}
+            for scenario in args.scenario or SCENARIOS:
+                print(f'{INFO}INFO: running {scenario} scenario.{RESET}')
+                results[scenario] = run_scenario(scenario, work, env, args.jobs)
+        finally:
+            server.shutdown()
+
+    report(results)
+    if args.json is not None:
+        with args.json.open('w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -90,26 +90,44 @@ Honestly, I'm stupid for not just using `nix` ...
 
 from __future__ import annotations
 
+import atexit
 import json
 import os
+import re
 import sys
 
 from abc import ABC, abstractmethod
-from argparse import ArgumentParser
+from argparse import SUPPRESS, ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from configparser import ConfigParser
+from contextlib import ExitStack, contextmanager
 from csv import reader as csv_reader
+from functools import lru_cache, partial, wraps
 from getpass import getpass, getuser
+from hashlib import sha256
+from http.client import BadStatusLine, HTTPConnection, HTTPResponse, HTTPSConnection
+from io import RawIOBase
 from json import load as load_json
+from multiprocessing import get_context
 from os.path import expanduser, expandvars, normpath
-from pathlib import Path
-from shutil import copyfile, copytree, rmtree, which
-from shlex import quote
+from pathlib import Path, PurePosixPath
+from pty import openpty
+from resource import RUSAGE_CHILDREN, getrusage
+from select import select
+from shutil import copyfile, copyfileobj, copytree, rmtree, which
 from string import Template
-from subprocess import run
-from tarfile import open as taropen
+from subprocess import DEVNULL, PIPE, STDOUT, CalledProcessError, CompletedProcess, Popen, TimeoutExpired
+from subprocess import run as _subprocess_run
+from tarfile import TarInfo, data_filter, open as taropen
 from tempfile import TemporaryDirectory
-from typing import Optional, Union, List, Dict, Tuple, Literal
-from urllib.request import urlretrieve
+from termios import ECHO, TCSANOW, tcgetattr, tcsetattr
+from threading import BoundedSemaphore, Event, Lock, get_ident, get_native_id
+from time import perf_counter, thread_time, time
+from typing import Any, BinaryIO, Callable, Collection, Iterable, Iterator, Optional, Union, List, Dict, Set, Tuple
+from typing import Literal
+from urllib.parse import urljoin, urlsplit
+from urllib.request import url2pathname
+from zipfile import ZipFile
 
 # enable fancy messages
 ERROR = '\033[30\033[41m'
@@ -119,6 +137,7 @@ INFO = '\033[30\033[44m'
 RESET = '\033[0m'
 
 ASSET_DIR = Path(__file__).parent / 'assets'
+SCRIPT_DIR = Path(__file__).parent.parent / 'scripts/.local/bin'
 
 
 def clean_path(path: Union[str, Path]) -> Path:
@@ -135,18 +154,1332 @@ def parse_args(args: Optional[List[str]] = None):
         epilog='Should support Debian and RHEL based OSs alike, if provided with an appropriate packages file.'
     )
 
+    parser.add_argument('command', nargs='?', choices=('install', 'bundle'), default='install',
+                        help='install everything (the default), or download everything into a bundle for offline '
+                             'installs')
+
     parser.add_argument('-p', '--packages', type=Path, default=ASSET_DIR / 'packages.json',
                         help='JSON file that specifies which packages to install')
     parser.add_argument('-c', '--config', type=Path, default=ASSET_DIR / 'gsettings.conf',
                         help='GNOME key file that specifies dconf options to set')
+    parser.add_argument('--full-dconf', action='store_true',
+                        help='load the whole GNOME key file into dconf, instead of only the keys that changed')
     parser.add_argument('-s', '--stow', type=Path, default=ASSET_DIR / 'stow.json',
                         help='JSON file containing a list of packages to stow')
     parser.add_argument('-i', '--ide', type=Path, default=ASSET_DIR / 'ides.json',
                         help='JSON file containing a list of IDEs to install')
+    parser.add_argument('--fonts', type=Path, default=ASSET_DIR / 'fonts.json',
+                        help='JSON file containing a list of font archive URLs')
+
+    parser.add_argument('-b', '--bundle', type=Path,
+                        help='install from this bundle without network access, or where to write it with "bundle"')
+
+    parser.add_argument('--unstow', action='store_true',
+                        help='remove the symlinks of the stowed packages, and exit')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only show what stowing (or --unstow) would change, and exit')
+
+    parser.add_argument('--cache-only', action='store_true',
+                        help='install downloaded artifacts from the cache only, without touching the network')
+    parser.add_argument('--cache-size', type=float, default=16,
+                        help='maximum size of the download cache in GiB, least recently used artifacts are evicted')
+
+    parser.add_argument('--no-wheelhouse', action='store_true',
+                        help='install pip packages from the package index, instead of through a cache of built wheels')
+    parser.add_argument('--refresh-pip', action='store_true',
+                        help='resolve the pip packages again, to pick up new releases, instead of installing the '
+                             'versions locked by an earlier run')
+
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='maximum number of setup steps to run concurrently')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        help='keep running independent steps after a step failed, instead of aborting')
+
+    parser.add_argument('--resume', action='store_true',
+                        help='skip steps that completed in a previous run, if their inputs did not change since')
+    parser.add_argument('--force', action='append', default=[], metavar='STEP',
+                        help='run STEP even if it would be skipped by --resume, can be passed multiple times')
+    parser.add_argument('--skip', action='append', default=[], metavar='STEP',
+                        help='do not run STEP, nor the steps depending on it, can be passed multiple times')
 
     parser.add_argument('-v', '--verbose', action='store_true', help='more verbose output')
+    parser.add_argument('--trace', type=Path, metavar='PATH',
+                        help='write timings of the setup steps as a Chrome trace, for Perfetto or chrome://tracing')
+
+    # used internally, to start the `PrivilegedHelper`
+    parser.add_argument('--privileged-helper', action='store_true', help=SUPPRESS)
+
+    parsed = parser.parse_args(args)
+    if parsed.command == 'bundle' and (parsed.unstow or parsed.dry_run):
+        parser.error('--unstow and --dry-run only apply to installing')
+    return parsed
+
+
+def get_state_dir() -> Path:
+    """ Return the directory for data that should persist between runs, but isn't worth backing up. """
+    return clean_path(os.getenv('XDG_STATE_HOME', '~/.local/state')) / 'dotfiles-setup'
+
+
+def fingerprint(*inputs: Union[str, int, float, bool, None, Path, list, tuple, dict]) -> str:
+    """
+    Return a digest of the inputs of a setup step. Paths are represented by their content (directories recursively,
+    including file names), everything else by its JSON representation.
+    """
+    digest = sha256()
+    for value in inputs:
+        if isinstance(value, Path) and value.is_dir():
+            for child in sorted(value.rglob('*')):
+                if child.is_file():
+                    digest.update(f'{child.relative_to(value)}\0{file_digest(child)}\0'.encode())
+        elif isinstance(value, Path):
+            digest.update(f'{file_digest(value) if value.is_file() else "missing"}\0'.encode())
+        else:
+            digest.update(json.dumps(value, sort_keys=True, default=str).encode() + b'\0')
+    return digest.hexdigest()
+
+
+def read_json(path: Path, default: Any = None) -> Any:
+    """ Return the content of a JSON file, or `default` if it's missing or broken. """
+    try:
+        with path.open() as json_file:
+            return load_json(json_file)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json_atomic(path: Path, content: Any, indent: Optional[int] = 2) -> None:
+    """ Write a JSON file through a temporary file next to it, so concurrent readers never see half a file. """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.{get_ident()}')
+    with tmp_path.open('w') as json_file:
+        json.dump(content, json_file, indent=indent)
+    tmp_path.replace(path)
+
+
+class Journal:
+    """
+    Persistent record of the setup steps that completed, together with a fingerprint of their inputs, so a later run
+    can skip them if nothing changed.
+    """
+
+    path: Path
+    entries: Dict[str, Dict[str, Union[str, float]]]
+
+    def __init__(self, path: Optional[Path] = None):
+        """
+        :param path: Where to keep the journal. Defaults to ``$XDG_STATE_HOME/dotfiles-setup/journal.json``.
+        """
+        self.path = path if path is not None else get_state_dir() / 'journal.json'
+        self._lock = Lock()
+        self.entries = read_json(self.path, {})
+
+    def is_done(self, step: str, step_fingerprint: str) -> bool:
+        """ Whether a step completed before, with the same inputs. """
+        with self._lock:
+            return self.entries.get(step, {}).get('fingerprint') == step_fingerprint
+
+    def record(self, step: str, step_fingerprint: str) -> None:
+        """ Remember that a step completed with the given inputs, and write the journal to disk right away. """
+        with self._lock:
+            self.entries[step] = {'fingerprint': step_fingerprint, 'completed': time()}
+            write_json_atomic(self.path, self.entries)
+
+
+class Profiler:
+    """
+    Collect timed spans of the setup, e.g. steps, package installs and subprocess calls, together with the resources
+    they used, for a summary at the end, or as a trace for Perfetto and ``chrome://tracing``.
+
+    Bytes downloaded and written are counted process-wide, so the numbers of spans overlapping in time include each
+    other's traffic. Peak RSS is the maximum over all child processes waited for up to the end of a span.
+    """
+
+    spans: List[Dict[str, Union[str, int, float, dict]]]
+    counters: Dict[str, int]
+
+    def __init__(self):
+        self.spans = []
+        self.counters = {'downloaded': 0, 'written': 0}
+        self._lock = Lock()
+        self._origin = perf_counter()
+
+    def count(self, counter: str, amount: int) -> None:
+        """ Add `amount` to one of the `counters`. """
+        with self._lock:
+            self.counters[counter] += amount
+
+    @contextmanager
+    def span(self, name: str, category: str, **details: str) -> Iterator[None]:
+        """ Record a span covering the block, under `name`, with extra `details` to show in the trace. """
+        with self._lock:
+            counters = dict(self.counters)
+        start, cpu_start = perf_counter(), thread_time()
+        try:
+            yield
+        finally:
+            end, cpu = perf_counter(), thread_time() - cpu_start
+            peak_rss = getrusage(RUSAGE_CHILDREN).ru_maxrss
+            with self._lock:
+                self.spans.append({
+                    'name': name,
+                    'cat': category,
+                    'ph': 'X',
+                    'ts': (start - self._origin) * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': os.getpid(),
+                    'tid': get_native_id(),
+                    'args': {
+                        **details,
+                        'cpu_s': round(cpu, 3),
+                        'downloaded_bytes': self.counters['downloaded'] - counters['downloaded'],
+                        'written_bytes': self.counters['written'] - counters['written'],
+                        'children_peak_rss_kib': peak_rss,
+                    },
+                })
+
+    def export(self, path: Path) -> None:
+        """ Write the spans in the Chrome trace event format. """
+        with self._lock:
+            trace = {'traceEvents': list(self.spans), 'displayTimeUnit': 'ms'}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as trace_file:
+            json.dump(trace, trace_file)
+
+    def summary(self, top: int = 10) -> None:
+        """ Print the `top` longest spans. """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span['dur'], reverse=True)[:top]
+        if not spans:
+            return
+
+        width = max(len(f'{span["cat"]}:{span["name"]}') for span in spans)
+        print(f'{INFO}{"span":<{width}}  {"wall":>8}  {"cpu":>7}  {"down MiB":>8}  {"write MiB":>9}  '
+              f'{"peak RSS MiB":>12}{RESET}')
+        for span in spans:
+            stats = span['args']
+            print(f'{span["cat"] + ":" + span["name"]:<{width}}  {span["dur"] / 1e6:7.1f}s  {stats["cpu_s"]:6.1f}s  '
+                  f'{stats["downloaded_bytes"] / 1024 ** 2:8.1f}  {stats["written_bytes"] / 1024 ** 2:9.1f}  '
+                  f'{stats["children_peak_rss_kib"] / 1024:12.1f}')
+
+
+profiler = Profiler()
+
+
+def profiled(category: str) -> Callable[[Callable], Callable]:
+    """ Decorator recording every call of a function as a span of the given category. """
+
+    def decorate(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiler.span(func.__qualname__, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def run(args: Union[str, List[Union[str, Path]]], **kwargs) -> CompletedProcess:
+    """ `subprocess.run`, recorded as a span by the `profiler`. Nothing is started once the setup was interrupted. """
+    check_interrupted()
+    command = [str(arg) for arg in args] if not isinstance(args, str) else args.split()
+    with profiler.span(Path(command[0]).name, 'subprocess', command=' '.join(command)):
+        return _subprocess_run(args, **kwargs)
+
+
+# set when the user interrupts the setup, so the steps still running stop at their next `check_interrupted`
+interrupted = Event()
+
+
+def check_interrupted() -> None:
+    """
+    Stop a step running on a worker thread, once the user interrupted the setup. Called before every subprocess, and
+    between the chunks or items of long loops, i.e. downloads, extraction and font cleaning.
+
+    :raise RuntimeError: If the setup was interrupted.
+    """
+    if interrupted.is_set():
+        raise RuntimeError('Interrupted by the user')
+
+TaskStatus = Literal['pending', 'running', 'done', 'unchanged', 'failed', 'skipped']
+
+
+class Task:
+    """ A named setup step, that may only run after the steps it depends on are done. """
+
+    name: str
+    action: Callable[[], None]
+    depends: Tuple[str, ...]
+    fingerprint: Optional[Callable[[], str]]
+    status: TaskStatus
+    error: Optional[Exception]
+    elapsed: float
+
+    def __init__(self,
+                 name: str,
+                 action: Callable[[], None],
+                 depends: Tuple[str, ...] = (),
+                 fingerprint: Optional[Callable[[], str]] = None):
+        self.name = name
+        self.action = action
+        self.depends = tuple(depends)
+        self.fingerprint = fingerprint
+        self.status = 'pending'
+        self.error = None
+        self.elapsed = 0.0
+
+    def run(self, journal: Optional[Journal] = None, skip_unchanged: bool = False) -> None:
+        """
+        Run the action, and record how it went, instead of raising.
+
+        :param journal: Where to record successful runs, if the step has a fingerprint.
+        :param skip_unchanged: Don't run the action, if the journal says it completed with the same inputs before.
+        """
+        start = perf_counter()
+        try:
+            step_fingerprint = self.fingerprint() if journal is not None and self.fingerprint is not None else None
+            if step_fingerprint is not None and skip_unchanged and journal.is_done(self.name, step_fingerprint):
+                self.status = 'unchanged'
+                print(f'{INFO}INFO: skipping {self.name}, nothing changed since it last completed.{RESET}')
+                return
+
+            print(f'{INFO}INFO: starting {self.name}.{RESET}')
+            with profiler.span(self.name, 'step'):
+                self.action()
+            if step_fingerprint is not None:
+                journal.record(self.name, step_fingerprint)
+        except Exception as error:
+            self.status = 'failed'
+            self.error = error
+            print(f'{ERROR}ERROR: {self.name} failed: {error.__class__.__name__}: {error}{RESET}')
+        else:
+            self.status = 'done'
+            print(f'{SUCCESS}SUCCESS: finished {self.name}.{RESET}')
+        finally:
+            self.elapsed = perf_counter() - start
+
+
+class TaskGraph:
+    """
+    Run setup steps on a bounded pool of worker threads, respecting declared dependencies between them.
+
+    Steps that don't depend on each other run concurrently. If a step fails, no new steps are started, unless
+    `keep_going` is set, in which case only the steps depending on the failed one are skipped.
+
+    Steps with a fingerprint are recorded in the `journal` once they complete. With `resume` set, such steps are
+    skipped, if they completed before with the same fingerprint, and aren't listed in `force`. Steps listed in `skip`
+    don't run at all, just like the steps depending on them.
+
+    On Ctrl-C, the steps that haven't started are cancelled, and those running are told to stop via `interrupted`.
+    They stop at their next `check_interrupted`, and the process exits once they did. Subprocesses get the interrupt
+    from the terminal.
+    """
+
+    tasks: Dict[str, Task]
+    jobs: int
+    keep_going: bool
+    journal: Optional[Journal]
+    resume: bool
+    force: Tuple[str, ...]
+    skip: Tuple[str, ...]
+
+    def __init__(self,
+                 jobs: int = 4,
+                 keep_going: bool = False,
+                 journal: Optional[Journal] = None,
+                 resume: bool = False,
+                 force: Tuple[str, ...] = (),
+                 skip: Tuple[str, ...] = ()):
+        self.tasks = {}
+        self.jobs = max(1, jobs)
+        self.keep_going = keep_going
+        self.journal = journal
+        self.resume = resume
+        self.force = tuple(force)
+        self.skip = tuple(skip)
+
+    def add(self,
+            name: str,
+            action: Callable[[], None],
+            depends: Tuple[str, ...] = (),
+            fingerprint: Optional[Callable[[], str]] = None) -> Task:
+        """
+        Register a step.
+
+        :param name: Unique name of the step.
+        :param action: Callable doing the actual work.
+        :param depends: Names of the steps that need to be done before this one can start.
+        :param fingerprint: Callable returning a digest of the inputs of the step, see `fingerprint`.
+        :return: The registered task.
+        """
+        assert name not in self.tasks, f'Duplicate task {name}'
+        task = self.tasks[name] = Task(name, action, depends, fingerprint)
+        return task
+
+    def run(self) -> None:
+        """
+        Run all registered steps, and print a status report afterwards.
+
+        :raise RuntimeError: If any step failed.
+        """
+        self._check()
+        for name in self.skip:
+            self.tasks[name].status = 'skipped'
+
+        running: Dict[Future, Task] = {}
+        aborted = False
+
+        pool = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            while True:
+                if not aborted:
+                    for task in self._ready():
+                        task.status = 'running'
+                        skip_unchanged = self.resume and task.name not in self.force
+                        running[pool.submit(task.run, self.journal, skip_unchanged)] = task
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if task.status == 'failed' and not self.keep_going:
+                        print(f'{WARNING}WARNING: aborting, waiting for running steps to finish.{RESET}')
+                        aborted = True
+        except KeyboardInterrupt:
+            # subprocesses get the interrupt from the terminal as well
+            interrupted.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+
+        for task in self.tasks.values():
+            if task.status == 'pending':
+                task.status = 'skipped'
+
+        self.report()
+
+        failed = [task.name for task in self.tasks.values() if task.status == 'failed']
+        if failed:
+            raise RuntimeError(f'Setup steps failed: {", ".join(failed)}')
+
+    def report(self) -> None:
+        """ Print the status of every step. """
+        colors = {'done': SUCCESS, 'failed': ERROR, 'skipped': WARNING}
+        width = max((len(name) for name in self.tasks), default=0)
+        for task in self.tasks.values():
+            color = colors.get(task.status, INFO)
+            print(f'{color}{task.name:<{width}}  {task.status:<9}  {task.elapsed:7.1f}s{RESET}')
+
+    def _ready(self) -> List[Task]:
+        """ Skip the steps that can't run anymore, and return the pending steps whose dependencies are all done. """
+        skipped = True
+        while skipped:
+            skipped = False
+            for task in self.tasks.values():
+                if task.status == 'pending' and any(self.tasks[dep].status in ('failed', 'skipped')
+                                                    for dep in task.depends):
+                    print(f'{WARNING}WARNING: skipping {task.name}, because a dependency did not finish.{RESET}')
+                    task.status = 'skipped'
+                    skipped = True
+
+        return [
+            task for task in self.tasks.values()
+            if task.status == 'pending' and all(self.tasks[dep].status in ('done', 'unchanged') for dep in task.depends)
+        ]
+
+    def _check(self) -> None:
+        """ Make sure all dependencies and forced steps exist, and that there are no cycles. """
+        for name in (*self.force, *self.skip):
+            assert name in self.tasks, f'Unknown step {name}, expected one of: {", ".join(self.tasks)}'
+        for task in self.tasks.values():
+            for dep in task.depends:
+                assert dep in self.tasks, f'Task {task.name} depends on unknown task {dep}'
+
+        visiting, visited = set(), set()
+
+        def visit(name: str) -> None:
+            assert name not in visiting, f'Dependency cycle involving task {name}'
+            if name in visited:
+                return
+            visiting.add(name)
+            for dep in self.tasks[name].depends:
+                visit(dep)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.tasks:
+            visit(name)
+
+
+def get_cache_dir() -> Path:
+    """ Return the directory for data that is expensive to get, but may be deleted at any time. """
+    return clean_path(os.getenv('XDG_CACHE_HOME', '~/.cache')) / 'dotfiles-setup'
+
+
+def file_digest(path: Path) -> str:
+    """ Return the SHA-256 hex digest of a file. """
+    digest = sha256()
+    with path.open('rb') as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadCache:
+    """
+    A persistent, size bounded cache for downloaded artifacts.
+
+    Entries are keyed by URL and (optionally) the expected SHA-256 checksum of the content. The file extension of the
+    URL is kept, because some tools care about it (e.g. ``gnome-extensions``). Next to every entry a small
+    JSON file stores the validators (``ETag`` and ``Last-Modified``) of the response it came from, and when it was last
+    used. If the cache grows larger than `max_size`, the least recently used entries are evicted. Entries used by this
+    process are kept, since callers may still open the paths they got, so the cache may exceed `max_size` for a run.
+    """
+
+    root: Path
+    max_size: int
+
+    def __init__(self, root: Optional[Path] = None, max_size: int = 16 * 1024 ** 3):
+        """
+        :param root: Where to keep the cached files. Defaults to ``$XDG_CACHE_HOME/dotfiles-setup/downloads``.
+        :param max_size: The maximum size of all entries in bytes.
+        """
+        self.root = root if root is not None else get_cache_dir() / 'downloads'
+        self.max_size = max_size
+        self._lock = Lock()
+        # keys of the entries handed out by this process
+        self._used: Set[str] = set()
+
+    @staticmethod
+    def key(url: str, checksum: Optional[str] = None) -> str:
+        digest = sha256(f'{url}\n{checksum or ""}'.encode()).hexdigest()
+        suffix = ''.join(Path(urlsplit(url).path).suffixes[-2:])
+        return digest + (suffix if re.fullmatch(r'[\w.-]*', suffix) else '')
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def part(self, key: str) -> Path:
+        """ Return where a download for this entry is stored, while it is still incomplete. """
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.with_name(f'{key}.part')
+
+    def meta_path(self, key: str) -> Path:
+        return self.path(key).with_name(f'{key}.json')
+
+    def lookup(self, key: str) -> Optional[Dict[str, Union[str, int, float, None]]]:
+        """ Return the metadata of an entry, or None if there is no such entry. """
+        meta = read_json(self.meta_path(key))
+        return meta if meta is not None and self.path(key).is_file() else None
+
+    def touch(self, key: str) -> Path:
+        """ Mark an entry as recently used, and return its path. """
+        meta = self.lookup(key)
+        meta['used'] = time()
+        self._write_meta(key, meta)
+        with self._lock:
+            self._used.add(key)
+        return self.path(key)
+
+    def commit(self, key: str, url: str, checksum: Optional[str], headers: Dict[str, Optional[str]]) -> Path:
+        """
+        Turn a completed partial download into a cache entry.
+
+        :param key: Key of the entry.
+        :param url: Where the content came from.
+        :param checksum: The expected SHA-256 checksum, if known.
+        :param headers: Validators of the response, i.e. the values of the ``ETag`` and ``Last-Modified`` headers.
+        :raise ValueError: If the content doesn't match the checksum.
+        :return: Path of the entry.
+        """
+        part = self.part(key)
+        if checksum is not None and (actual := file_digest(part)) != checksum.lower():
+            part.unlink()
+            raise ValueError(f'Checksum mismatch for {url}: expected {checksum}, got {actual}')
+
+        path = self.path(key)
+        with self._lock:
+            self._used.add(key)
+        part.replace(path)
+        self._write_meta(key, {
+            'url': url,
+            'sha256': checksum,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'size': path.stat().st_size,
+            'used': time(),
+        })
+        self.evict()
+        return path
+
+    def evict(self) -> None:
+        """ Delete the least recently used entries, until the cache fits into `max_size` again. """
+        with self._lock:
+            entries = []
+            for meta_path in self.root.glob('*/*.json'):
+                meta = read_json(meta_path, {})
+                if 'used' in meta and 'size' in meta:
+                    entries.append((meta['used'], meta['size'], meta_path))
+
+            total = sum(size for _, size, _ in entries)
+            for used, size, meta_path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if meta_path.name[:-5] in self._used:
+                    continue
+                print(f'{INFO}INFO: evicting {meta_path.name[:-5]} from the download cache.{RESET}')
+                meta_path.with_name(meta_path.name[:-5]).unlink(missing_ok=True)
+                meta_path.unlink(missing_ok=True)
+                total -= size
+
+    def _write_meta(self, key: str, meta: Dict[str, Union[str, int, float, None]]) -> None:
+        write_json_atomic(self.meta_path(key), meta, indent=None)
+
+
+class _TeeReader(RawIOBase):
+    """
+    Read the first `offset` bytes from `prefix`, and the rest from `source`, while copying everything read from
+    `source` to `sink`.
+    """
+
+    def __init__(self,
+                 prefix: Optional[BinaryIO],
+                 offset: int,
+                 source: Optional[HTTPResponse],
+                 sink: BinaryIO,
+                 progress: Callable[[int], None]):
+        super().__init__()
+        self.prefix = prefix
+        self.remaining = offset
+        self.source = source
+        self.sink = sink
+        self.progress = progress
+        self.done = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        check_interrupted()
+        if self.remaining:
+            data = self.prefix.read(min(len(buffer), self.remaining))
+            self.remaining -= len(data)
+        elif self.source is not None:
+            # whatever arrived, so an interrupt isn't held up by a slow server
+            data = self.source.read1(len(buffer))
+            self.sink.write(data)
+            profiler.count('downloaded', len(data))
+            profiler.count('written', len(data))
+        else:
+            data = b''
+
+        buffer[:len(data)] = data
+        self.done += len(data)
+        if data:
+            self.progress(self.done)
+        return len(data)
+
+
+class _SliceReader(RawIOBase):
+    """ Read `size` bytes of a file, starting at `offset`, while hashing them. """
+
+    def __init__(self, file: BinaryIO, offset: int, size: int):
+        super().__init__()
+        self.file = file
+        self.file.seek(offset)
+        self.remaining = size
+        self.digest = sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        check_interrupted()
+        data = self.file.read(min(len(buffer), self.remaining))
+        self.remaining -= len(data)
+        self.digest.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class Bundle:
+    """
+    An uncompressed tar archive with everything the setup would download, for installing without network access. It's
+    built by ``setup.py bundle``.
+
+    The archive starts with an ``index.json`` member, that records which package manager the system packages are for,
+    and where the artifact of every URL is stored, together with its SHA-256 checksum. System packages are stored
+    below ``packages/``, pip packages below ``wheels/``, and everything else below ``downloads/``. For the system
+    packages, the index records which package every file contains, and which packages every requested package needs.
+
+    Since the archive isn't compressed, members are read straight from their offset in the file.
+    """
+
+    path: Path
+    index: Dict[str, Union[str, int, float, list, dict]]
+
+    index_name = 'index.json'
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = clean_path(path)
+        self._members: Dict[str, Tuple[int, int]] = {}
+        with taropen(self.path, 'r:') as tarfile:
+            for member in tarfile:
+                if member.isfile():
+                    self._members[member.name] = (member.offset_data, member.size)
+            self.index = load_json(tarfile.extractfile(self.index_name))
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.index['downloads']
+
+    @contextmanager
+    def open(self, url: str, checksum: Optional[str] = None) -> Iterator[BinaryIO]:
+        """
+        Yield a readable stream of the artifact of a URL. The content is verified when the block exits without error.
+
+        :raise KeyError: If the URL isn't in the bundle.
+        :raise ValueError: If the content doesn't match the checksum given, or the one recorded when bundling.
+        """
+        entry = self.index['downloads'][url]
+        if checksum is not None and checksum.lower() != entry['sha256']:
+            raise ValueError(f'Checksum of {url} in the bundle is {entry["sha256"]}, expected {checksum}')
+
+        with self.path.open('rb') as file:
+            reader = _SliceReader(file, *self._members[entry['member']])
+            yield reader
+            while reader.read(1024 * 1024):
+                pass
+            if reader.digest.hexdigest() != entry['sha256']:
+                raise ValueError(f'Content of {url} in the bundle is corrupted')
+
+    @contextmanager
+    def unpacked(self, prefix: str, names: Optional[Collection[str]] = None) -> Iterator[Path]:
+        """
+        Yield a temporary directory with the files of the bundle below `prefix` (e.g. "wheels"), without it.
+
+        :param prefix: The directory in the bundle.
+        :param names: Only unpack the files with these names. All files are unpacked if not set.
+        """
+        with TemporaryDirectory(prefix='dotfiles-bundle-') as tmp, self.path.open('rb') as file:
+            for name, (offset, size) in self._members.items():
+                if name.startswith(prefix + '/') and (names is None or PurePosixPath(name).name in names):
+                    with (Path(tmp) / PurePosixPath(name).name).open('wb') as out_file:
+                        copyfileobj(_SliceReader(file, offset, size), out_file)
+            # the privileged helper installs system packages from here
+            Path(tmp).chmod(0o755)
+            yield Path(tmp)
+
+
+ProgressCallback = Callable[[str, int, Optional[int]], None]
+
+
+class DownloadManager:
+    """
+    Fetch artifacts over HTTP(S) concurrently.
+
+    Connections are kept alive and reused per host, but never more than `per_host` requests hit the same host at
+    once. Partial downloads are kept next to the destination (with a ``.part`` suffix), and resumed with a ``Range``
+    request on the next attempt. The request carries the validators of the partial download in ``If-Range``, so the
+    server sends everything again, if the content changed in between.
+
+    Artifacts requested via `fetch` go through a `DownloadCache`, and are only downloaded again if the server says they
+    changed. In `offline` mode, the network isn't touched at all. Artifacts in the `bundle` are taken from there.
+    """
+
+    max_workers: int
+    per_host: int
+    timeout: float
+    progress: ProgressCallback
+    cache: DownloadCache
+    offline: bool
+    bundle: Optional[Bundle]
+
+    _chunk_size = 1024 * 1024
+    _max_redirects = 10
+
+    def __init__(self,
+                 max_workers: int = 8,
+                 per_host: int = 2,
+                 timeout: float = 60,
+                 progress: Optional[ProgressCallback] = None,
+                 cache: Optional[DownloadCache] = None,
+                 offline: bool = False,
+                 bundle: Optional[Bundle] = None):
+        """
+        :param max_workers: Maximum number of concurrent downloads.
+        :param per_host: Maximum number of concurrent connections to a single host.
+        :param timeout: Socket timeout in seconds.
+        :param progress: Called with (name, bytes_done, bytes_total) while downloading. Prints every 10% by default.
+        :param cache: The cache used by `fetch`. Defaults to a cache in ``$XDG_CACHE_HOME``.
+        :param offline: Only serve `fetch` from the cache, without revalidating entries.
+        :param bundle: An offline bundle, to take artifacts from instead of the network or cache.
+        """
+        self.max_workers = max(1, max_workers)
+        self.per_host = max(1, per_host)
+        self.timeout = timeout
+        self.progress = progress if progress is not None else self._print_progress
+        self.cache = cache if cache is not None else DownloadCache()
+        self.offline = offline
+        self.bundle = bundle
+
+        self._lock = Lock()
+        self._idle: Dict[Tuple[str, str], List[HTTPConnection]] = {}
+        self._host_limits: Dict[str, BoundedSemaphore] = {}
+        self._key_locks: Dict[str, Lock] = {}
+        self._reported: Dict[str, int] = {}
+
+    def fetch_all(self, artifacts: List[Tuple[str, Optional[str]]]) -> List[Path]:
+        """
+        Fetch several URLs concurrently through the cache.
+
+        :param artifacts: Pairs of (url, checksum), the checksum may be None.
+        :return: Paths of the cache entries, in the same order.
+        """
+        if not artifacts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(artifacts))) as pool:
+            futures = [pool.submit(self.fetch, url, checksum) for url, checksum in artifacts]
+            return [future.result() for future in futures]
+
+    def fetch(self, url: str, checksum: Optional[str] = None) -> Path:
+        """
+        Return the path of a cache entry for a URL, downloading or revalidating it as necessary. Entries without
+        validators are assumed to be immutable.
+
+        :param url: What to fetch.
+        :param checksum: Expected SHA-256 checksum of the content, if known.
+        :raise FileNotFoundError: If running offline, and the URL isn't cached.
+        :return: The path of the cache entry. It must not be modified.
+        """
+        if self.bundle is not None and url in self.bundle:
+            return self._fetch_bundled(url, checksum)
+        with self.open(url, checksum):
+            pass
+        return self.cache.path(self.cache.key(url, checksum))
+
+    @contextmanager
+    def open(self, url: str, checksum: Optional[str] = None) -> Iterator[BinaryIO]:
+        """
+        Yield a readable stream of the content of a URL, like `fetch` does, but without waiting for the download to
+        finish. While the stream is read, the content is written to the cache as well. The cache entry is only
+        committed once the block exits without error, so a checksum mismatch is raised at that point.
+
+        :param url: What to fetch.
+        :param checksum: Expected SHA-256 checksum of the content, if known.
+        :raise FileNotFoundError: If running offline, and the URL isn't cached.
+        """
+        if self.bundle is not None and url in self.bundle:
+            # streamed straight from the bundle, there's no point in caching it
+            with self.bundle.open(url, checksum) as stream:
+                yield stream
+            return
+
+        key = self.cache.key(url, checksum)
+        name = Path(urlsplit(url).path).name or url
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, Lock())
+
+        # only one thread may touch the partial file of an entry
+        with key_lock, ExitStack() as stack:
+            meta = self.cache.lookup(key)
+            if meta is None and self.offline:
+                raise FileNotFoundError(f'{url} is not in the download cache, and running with --cache-only')
+
+            conditions = {}
+            if meta is not None and meta.get('etag'):
+                conditions['If-None-Match'] = meta['etag']
+            if meta is not None and meta.get('last_modified'):
+                conditions['If-Modified-Since'] = meta['last_modified']
+
+            stream = None
+            if meta is None or (conditions and not self.offline):
+                try:
+                    stream = stack.enter_context(self._stream(url, self.cache.part(key), name, conditions))
+                except (OSError, RuntimeError) as error:
+                    if meta is None:
+                        raise
+                    print(f'{WARNING}WARNING: could not revalidate {name}, using cached copy: {error}{RESET}')
+                else:
+                    if stream is None:
+                        # not modified
+                        self.cache.part(key).unlink(missing_ok=True)
+
+            if stream is None:
+                with self.cache.touch(key).open('rb') as file:
+                    yield file
+                return
+
+            reader, validators = stream
+            yield reader
+
+        # the stream has been drained, and the partial file closed when leaving the block above
+        self.cache.commit(key, url, checksum, validators)
+
+    def _fetch_bundled(self, url: str, checksum: Optional[str] = None) -> Path:
+        """ Like `fetch`, but copy the artifact from the bundle into the cache, for tools that need a file. """
+        key = self.cache.key(url, checksum)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, Lock())
+
+        with key_lock:
+            if self.cache.lookup(key) is not None:
+                return self.cache.touch(key)
+            with self.bundle.open(url, checksum) as stream, self.cache.part(key).open('wb') as part:
+                copyfileobj(stream, part)
+            return self.cache.commit(key, url, checksum, {})
+
+    @contextmanager
+    def _stream(self, url: str, part: Path, name: str, conditions: Optional[Dict[str, str]] = None) \
+            -> Iterator[Optional[Tuple[BinaryIO, Dict[str, Optional[str]]]]]:
+        """
+        Download a URL into a partial file, resuming it if it already has content. Yield a stream of the complete
+        content, together with the validators of the response, instead of waiting for the download to finish. Yields
+        None if the server says the content didn't change.
+
+        The stream starts with whatever the partial file already holds, and everything read from the network is
+        appended to the partial file. Whatever wasn't read when the block exits without error is read afterwards.
+
+        :param url: What to download.
+        :param part: The partial file.
+        :param name: Name to report progress under.
+        :param conditions: Headers for a conditional request.
+        """
+        offset = part.stat().st_size if part.exists() else 0
+        headers = dict(conditions or {})
+        part_validators = part.with_name(f'{part.name}.validators')
+        if offset:
+            if_range = self._if_range(part_validators)
+            if if_range is not None:
+                headers['Range'] = f'bytes={offset}-'
+                headers['If-Range'] = if_range
+            else:
+                # without validators, there's no telling whether the partial file is of the same content
+                offset = 0
+
+        with self._open(url, headers) as response:
+            if response.status == 304:
+                response.read()
+                yield None
+                return
+            elif response.status == 416:
+                # the server has nothing more to send, so the partial file already is complete
+                response.read()
+                source, mode = None, 'ab'
+            elif response.status == 206:
+                source, mode = response, 'ab'
+            elif response.status == 200:
+                source, mode, offset = response, 'wb', 0
+            else:
+                raise RuntimeError(f'Downloading {url} failed: {response.status} {response.reason}')
+
+            validators = {header: response.getheader(header) for header in ('ETag', 'Last-Modified')}
+            length = response.getheader('Content-Length') if source is not None else None
+            total = offset + int(length) if length is not None else None
+
+            with ExitStack() as stack:
+                prefix = stack.enter_context(part.open('rb')) if offset else None
+                sink = stack.enter_context(part.open(mode))
+                if mode == 'wb':
+                    # a later attempt may only resume, if the content is still the same
+                    write_json_atomic(part_validators, validators, indent=None)
+                reader = _TeeReader(prefix, offset, source, sink, lambda done: self.progress(name, done, total))
+                yield reader, validators
+                while reader.read(self._chunk_size):
+                    pass
+            part_validators.unlink(missing_ok=True)
+
+    @staticmethod
+    def _if_range(part_validators: Path) -> Optional[str]:
+        """ Return the value of the ``If-Range`` header for resuming a partial download, or None if it can't be. """
+        validators = read_json(part_validators)
+        if validators is None:
+            return None
+        # weak entity tags must not be used in If-Range
+        etag = validators.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return validators.get('Last-Modified')
+
+    @contextmanager
+    def _open(self, url: str, headers: Optional[Dict[str, str]] = None) -> Iterator[HTTPResponse]:
+        """
+        Send a GET request, following redirects, and yield the final response. The connection is handed back to the
+        pool afterwards, if the body was consumed completely, and the server wants to keep it open.
+        """
+        headers = dict(headers or {})
+        for _ in range(self._max_redirects):
+            scheme, netloc, path, query, _ = urlsplit(url)
+            target = f'{path or "/"}?{query}' if query else path or '/'
+
+            with self._host_limit(netloc):
+                conn, response = self._request(scheme, netloc, target, headers)
+                location = response.getheader('Location')
+                if response.status in (301, 302, 303, 307, 308) and location:
+                    response.read()
+                    self._release(scheme, netloc, conn, response)
+                    url = urljoin(url, location)
+                    continue
+
+                try:
+                    yield response
+                finally:
+                    self._release(scheme, netloc, conn, response)
+                return
+
+        raise RuntimeError(f'Too many redirects for {url}')
+
+    def _request(self, scheme: str, netloc: str, target: str,
+                 headers: Dict[str, str]) -> Tuple[HTTPConnection, HTTPResponse]:
+        """ Send a request on a pooled connection, and retry once on a fresh one, if the server dropped it. """
+        conn = self._acquire(scheme, netloc)
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except (ConnectionError, BadStatusLine):
+            conn.close()
+            conn = self._connect(scheme, netloc)
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+
+    @contextmanager
+    def _host_limit(self, netloc: str) -> Iterator[None]:
+        with self._lock:
+            limit = self._host_limits.setdefault(netloc, BoundedSemaphore(self.per_host))
+        with limit:
+            yield
+
+    def _connect(self, scheme: str, netloc: str) -> HTTPConnection:
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == 'http':
+            return HTTPConnection(netloc, timeout=self.timeout)
+        raise ValueError(f'Unsupported URL scheme {scheme}')
+
+    def _acquire(self, scheme: str, netloc: str) -> HTTPConnection:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        return self._connect(scheme, netloc)
+
+    def _release(self, scheme: str, netloc: str, conn: HTTPConnection, response: HTTPResponse) -> None:
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault((scheme, netloc), []).append(conn)
+        else:
+            conn.close()
+
+    def _print_progress(self, name: str, done: int, total: Optional[int]) -> None:
+        """ Print a line every 10% (or every 100 MiB, if the size is unknown). """
+        step = done * 10 // total if total else done // (100 * 1024 * 1024)
+        with self._lock:
+            if self._reported.get(name, -1) >= step:
+                return
+            self._reported[name] = step
+        size = f' of {total / 1024 ** 2:.1f} MiB' if total else ''
+        print(f'{INFO}INFO: downloaded {done / 1024 ** 2:.1f} MiB{size} of {name}.{RESET}')
+
+
+@profiled('extract')
+def extract_tar_stream(stream: BinaryIO, dest: Path, strip: int = 0) -> None:
+    """
+    Extract a (possibly compressed) tar archive in a single pass over a stream, that doesn't have to be seekable.
+    Only members passing the ``data`` extraction filter are allowed.
+
+    :param stream: The archive.
+    :param dest: Where to extract to.
+    :param strip: How many leading path components to remove from every member, like ``tar --strip-components``.
+    """
+
+    def strip_filter(member: TarInfo, path: str) -> Optional[TarInfo]:
+        check_interrupted()
+        parts = PurePosixPath(member.name).parts[strip:]
+        if not parts:
+            return None
+        changes = {'name': '/'.join(parts)}
+        # hard links point to other members, symlinks are relative to their own location
+        if member.islnk():
+            changes['linkname'] = '/'.join(PurePosixPath(member.linkname).parts[strip:])
+        member = data_filter(member.replace(**changes, deep=False), path)
+        if member is not None and member.isfile():
+            profiler.count('written', member.size)
+        return member
+
+    with taropen(fileobj=stream, mode='r|*') as tarfile:
+        tarfile.extractall(dest, filter=strip_filter)
+
+
+@contextmanager
+def staged_directory(dest: Path) -> Iterator[Path]:
+    """
+    Yield an empty directory next to `dest`, that replaces `dest` if the block exits without error, and is removed
+    otherwise. Readers of `dest` either see the old or the new content, never something half extracted.
+    """
+    staging = dest.with_name(f'.{dest.name}.staging')
+    retired = dest.with_name(f'.{dest.name}.old')
+    rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+
+    try:
+        yield staging
+    except BaseException:
+        rmtree(staging, ignore_errors=True)
+        raise
+
+    if dest.exists():
+        rmtree(retired, ignore_errors=True)
+        dest.rename(retired)
+        staging.rename(dest)
+        rmtree(retired)
+    else:
+        staging.rename(dest)
+
+
+class PrivilegedHelper:
+    """
+    A helper process running as root, so operations needing root don't each have to go through their own ``sudo``
+    shell invocation. It is started (and authenticated) once, on the first request, and then takes requests as JSON
+    lines over a pipe, answering each with a JSON line holding the result.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._proc: Optional[Popen] = None
+
+    def install_packages(self, pkg_mngr: str, pkgs: List[str], verbose: bool = False) -> int:
+        """
+        Install system packages, and return the exit code of the package manager. Its output is only shown if it
+        failed, or if `verbose` is set.
+        """
+        return self.request('install_packages', pkg_mngr=pkg_mngr, pkgs=pkgs, verbose=verbose)
+
+    def mkdir(self, path: Union[str, Path]) -> None:
+        """ Create a directory, including its parents. """
+        self.request('mkdir', path=str(path))
+
+    def copyfile(self, src: Union[str, Path], dst: Union[str, Path]) -> None:
+        self.request('copyfile', src=str(src), dst=str(dst))
+
+    def copytree(self, src: Union[str, Path], dst: Union[str, Path]) -> None:
+        """ Copy a directory tree, merging it into `dst` if that exists already. """
+        self.request('copytree', src=str(src), dst=str(dst))
+
+    def write_file(self, path: Union[str, Path], content: str) -> None:
+        self.request('write_file', path=str(path), content=content)
+
+    def request(self, op: str, **params: Union[str, bool, List[str]]) -> Union[int, None]:
+        """
+        Send a request to the helper, and wait for the result.
+
+        :raise RuntimeError: If the operation failed, or the helper isn't running.
+        """
+        with self._lock:
+            if self._proc is None:
+                self._start()
+            try:
+                self._proc.stdin.write(json.dumps({'op': op, **params}) + '\n')
+                self._proc.stdin.flush()
+                answer = self._proc.stdout.readline()
+            except BrokenPipeError:
+                answer = ''
+
+        if not answer:
+            raise RuntimeError(f'Privileged helper exited before finishing {op}')
+        response = json.loads(answer)
+        if 'error' in response:
+            raise RuntimeError(f'Privileged {op} failed: {response["error"]}')
+        return response.get('result')
+
+    def close(self) -> None:
+        """ Let the helper exit. """
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc = None
+
+    def _start(self) -> None:
+        print(f'{INFO}INFO: starting privileged helper, this may ask for your password.{RESET}')
+        command = [sys.executable, str(Path(__file__).resolve()), '--privileged-helper']
+        if os.geteuid() != 0:
+            command = ['sudo', *command]
+        self._proc = Popen(command, stdin=PIPE, stdout=PIPE, text=True)
+        atexit.register(self.close)
+
+
+def serve_privileged_requests() -> None:
+    """ The request loop of the `PrivilegedHelper`, running until its input is closed. """
+    # the real stdout carries the answers, everything else goes to stderr
+    requests, answers = sys.stdin, sys.stdout
+    sys.stdout = sys.stderr
+
+    for line in requests:
+        request = json.loads(line)
+        op = request['op']
+        try:
+            result = None
+            if op == 'install_packages':
+                # stdin is the request pipe, so the package manager must never prompt
+                cmd = [request['pkg_mngr'], 'install', '-y']
+                if request['pkg_mngr'] == 'apt':
+                    cmd += ['-o', 'Dpkg::Options::=--force-confold']
+                env = {**os.environ, 'DEBIAN_FRONTEND': 'noninteractive'}
+                output = {'stdout': sys.stderr} if request.get('verbose') else {'stdout': PIPE, 'stderr': STDOUT}
+                proc = run([*cmd, *request['pkgs']], stdin=DEVNULL, env=env, text=True, **output)
+                if proc.returncode != 0 and proc.stdout:
+                    sys.stderr.write(proc.stdout)
+                result = proc.returncode
+            elif op == 'mkdir':
+                Path(request['path']).mkdir(parents=True, exist_ok=True)
+            elif op == 'copyfile':
+                copyfile(request['src'], request['dst'])
+            elif op == 'copytree':
+                copytree(request['src'], request['dst'], dirs_exist_ok=True)
+            elif op == 'write_file':
+                Path(request['path']).write_text(request['content'])
+            else:
+                raise ValueError(f'Unknown operation {op}')
+        except Exception as error:
+            response = {'error': f'{error.__class__.__name__}: {error}'}
+        else:
+            response = {'result': result}
+
+        answers.write(json.dumps(response) + '\n')
+        answers.flush()
+
+
+_privileged_helper = PrivilegedHelper()
+
+
+def privileged() -> PrivilegedHelper:
+    """ Return the privileged helper shared by the whole run. """
+    return _privileged_helper
+
+
+class HostFacts:
+    """
+    Facts about the host, that several setup steps need: the package manager, the desktop environments in use, the
+    contents of ``/etc/os-release``, and which tools work.
+
+    All facts are probed at once, running the tool checks concurrently, and cached in ``$XDG_CACHE_HOME``. The cache is
+    keyed by ``/etc/os-release``, ``$PATH`` and ``$XDG_CURRENT_DESKTOP``, so it's only reused for the same host setup.
+    Tools that were missing are checked again when asked for, since the setup may have installed them in the meantime.
+    """
+
+    pkg_mngr: Optional[str]
+    desktops: Tuple[str, ...]
+    os_release: Dict[str, str]
+    tools: Dict[str, bool]
+
+    # how to check that a tool works, only for the tools that a step checks for with `has`
+    tool_checks = {
+        'git-lfs': ('git', 'lfs', 'version'),
+        'gnome-extensions': ('gnome-extensions', 'version'),
+    }
+
+    def __init__(self,
+                 pkg_mngr: Optional[str],
+                 desktops: Tuple[str, ...],
+                 os_release: Dict[str, str],
+                 tools: Dict[str, bool],
+                 path: Optional[Path] = None,
+                 key: Optional[str] = None):
+        self.pkg_mngr = pkg_mngr
+        self.desktops = tuple(desktops)
+        self.os_release = os_release
+        self.tools = dict(tools)
+        self._path = path
+        self._key = key
+        self._lock = Lock()
+
+    @classmethod
+    def probe(cls, path: Optional[Path] = None, refresh: bool = False) -> HostFacts:
+        """
+        Return the facts of this host, from the cache if it's still valid.
+
+        :param path: Where to cache the facts. Defaults to ``$XDG_CACHE_HOME/dotfiles-setup/host-facts.json``.
+        :param refresh: Probe again, even if the cache is valid.
+        """
+        path = path if path is not None else get_cache_dir() / 'host-facts.json'
+        try:
+            os_release_digest = file_digest(Path('/etc/os-release'))
+        except OSError:
+            os_release_digest = None
+        key = fingerprint(os_release_digest, os.getenv('PATH', ''), os.getenv('XDG_CURRENT_DESKTOP', ''))
+
+        cached = read_json(path, {}) if not refresh else {}
+        if isinstance(cached, dict) and cached.pop('key', None) == key:
+            try:
+                return cls(**cached, path=path, key=key)
+            except TypeError:
+                pass
+
+        with ThreadPoolExecutor(max_workers=len(cls.tool_checks)) as pool:
+            tools = dict(zip(cls.tool_checks, pool.map(cls._check_tool, cls.tool_checks)))
+
+        try:
+            os_release = get_os_release()
+        except OSError:
+            os_release = {}
+
+        pkg_mngr = 'apt' if which('apt') is not None else 'dnf' if which('dnf') is not None else None
+        desktops = tuple(desktop for desktop in os.getenv('XDG_CURRENT_DESKTOP', '').split(':') if desktop)
+        facts = cls(pkg_mngr, desktops, os_release, tools, path=path, key=key)
+        facts.save()
+        return facts
+
+    def save(self) -> None:
+        """ Write the facts to the cache. """
+        if self._path is None:
+            return
+        with self._lock:
+            write_json_atomic(self._path, {
+                'key': self._key,
+                'pkg_mngr': self.pkg_mngr,
+                'desktops': self.desktops,
+                'os_release': self.os_release,
+                'tools': self.tools,
+            })
+
+    def has(self, tool: str) -> bool:
+        """ Whether a tool from `tool_checks` works. """
+        if not self.tools.get(tool):
+            self.tools[tool] = self._check_tool(tool)
+            if self.tools[tool]:
+                self.save()
+        return self.tools[tool]
+
+    def is_debian(self) -> bool:
+        return self.pkg_mngr == 'apt'
+
+    def is_rhel(self) -> bool:
+        return self.pkg_mngr == 'dnf'
+
+    def is_gnome(self) -> bool:
+        """ Is GNOME used? Not necessarily mutually exclusive with `is_kde`! """
+        return 'GNOME' in self.desktops
+
+    def is_kde(self) -> bool:
+        """ Is KDE used? Not necessarily mutually exclusive with `is_gnome`! """
+        return 'KDE' in self.desktops
+
+    @classmethod
+    def _check_tool(cls, tool: str) -> bool:
+        command = cls.tool_checks[tool]
+        if which(command[0]) is None:
+            return False
+        # not through the profiled `run`, this is too small to be worth a span
+        return _subprocess_run(command, stdout=DEVNULL, stderr=DEVNULL).returncode == 0
 
-    return parser.parse_args(args)
+
+@lru_cache(maxsize=None)
+def get_host_facts() -> HostFacts:
+    """ Return the facts of this host, probing them only once per run. """
+    return HostFacts.probe()
 
 
 class PkgSpec(ABC):
@@ -169,8 +1502,10 @@ class SysPkgSpec(PkgSpec):
     """ Describes a set of packages to be installed from the system repositories. """
 
     pkgs: Tuple[str]
+    facts: HostFacts
 
-    def __init__(self, mapping: Dict[str, List[str]]):
+    def __init__(self, mapping: Dict[str, List[str]], facts: Optional[HostFacts] = None):
+        self.facts = facts if facts is not None else get_host_facts()
         pkgs = mapping.get('pkg', [])
 
         assert self.is_rhel() or self.is_debian(), 'Neither apt, nor dnf found in $PATH'
@@ -182,52 +1517,294 @@ class SysPkgSpec(PkgSpec):
 
         self.pkgs = tuple(pkgs)
 
+    @profiled('install')
     def install(self, verbose: bool = False) -> None:
-        """ Install the requested packages with the appropriate package manager. """
-        if self.pkgs:
-            pkg_mngr = 'apt' if self.is_debian() else 'dnf' if self.is_rhel() else None
-            assert pkg_mngr, 'No valid package manager found'
-            os.system(" ".join(['sudo', '-S', pkg_mngr, 'install', '-y', *self.pkgs]))
+        """ Install the requested packages with the appropriate package manager, unless they are installed already. """
+        install_system_packages([self], verbose)
+
+    def missing(self, installed: Set[str]) -> Tuple[str, ...]:
+        """ Return the requested packages, that aren't in a set of installed packages. """
+        return tuple(pkg for pkg in self.pkgs if pkg not in installed)
+
+    def pkg_mngr(self) -> str:
+        pkg_mngr = self.facts.pkg_mngr
+        assert pkg_mngr, 'No valid package manager found'
+        return pkg_mngr
 
     def is_rhel(self) -> bool:
         """ Find out whether this distro is RHEL based, by checking if `dnf` is available. """
-        return which('dnf') is not None
+        return self.facts.is_rhel()
 
     def is_debian(self) -> bool:
         """ Find out whether this distro is Debian based, by checking if `apt` is available. """
-        return which('apt') is not None
+        return self.facts.is_debian()
+
+
+def probe_installed_packages(pkg_mngr: str, pkgs: Iterable[str] = ()) -> Set[str]:
+    """
+    Return the names of the installed system packages, querying the package database only once.
+
+    On RPM based systems, a requested name may be something that a package provides, rather than the name of a package
+    (e.g. ``g++``). Such names from `pkgs` are checked with one more query, and included if they are provided.
+
+    :param pkg_mngr: Either "apt" or "dnf".
+    :param pkgs: Requested packages.
+    :return: Set of installed package names.
+    """
+    if pkg_mngr == 'apt':
+        query = run(['dpkg-query', '-W', '-f', '${db:Status-Abbrev} ${Package}\n'],
+                    capture_output=True, text=True, check=True)
+        # the status abbreviation is padded with spaces, e.g. "ii  bash"
+        return {
+            fields[-1]
+            for fields in (line.split() for line in query.stdout.splitlines())
+            if fields and fields[0].startswith('ii')
+        }
+
+    query = run(['rpm', '-qa', '--queryformat', '%{NAME}\n'], capture_output=True, text=True, check=True)
+    installed = set(query.stdout.split())
+
+    unknown = sorted(set(pkgs) - installed)
+    if unknown:
+        # exits non-zero if anything isn't provided, but tells us what exactly
+        provides = run(['rpm', '-q', '--whatprovides', *unknown], capture_output=True, text=True)
+        not_provided = {
+            line.removeprefix('no package provides ').strip()
+            for line in provides.stdout.splitlines()
+            if line.startswith('no package provides ')
+        }
+        installed.update(set(unknown) - not_provided)
+
+    return installed
+
+
+@profiled('install')
+def install_system_packages(specs: Iterable[SysPkgSpec], verbose: bool = False, bundle: Optional[Bundle] = None) \
+        -> None:
+    """
+    Install the packages of several specs in a single transaction, skipping those that are installed already.
+
+    :param specs: Package specs to install.
+    :param verbose: Whether to show package manager output.
+    :param bundle: An offline bundle to install the missing packages from, instead of fetching them from the network.
+    :raise RuntimeError: If the bundle was made for another package manager, or the package manager failed.
+    """
+    specs = [spec for spec in specs if spec is not None and spec.pkgs]
+    if not specs:
+        return
+
+    pkg_mngr = specs[0].pkg_mngr()
+    requested = list(dict.fromkeys(pkg for spec in specs for pkg in spec.pkgs))
+    installed = probe_installed_packages(pkg_mngr, requested)
+    missing = list(dict.fromkeys(pkg for spec in specs for pkg in spec.missing(installed)))
+
+    if not missing:
+        print(f'{INFO}INFO: all {len(requested)} system packages are installed already.{RESET}')
+        return
+
+    print(f'{INFO}INFO: installing {len(missing)} of {len(requested)} system packages: {" ".join(missing)}{RESET}')
+    if bundle is not None:
+        if bundle.index['pkg_mngr'] != pkg_mngr:
+            raise RuntimeError(f'The bundle contains packages for {bundle.index["pkg_mngr"]}, but this is a {pkg_mngr} '
+                               f'system')
+        # the bundle holds the packages of all desktops with all of their dependencies, only install what the missing
+        # packages need, and leave installed packages at their version
+        closures = bundle.index.get('closures', {})
+        not_bundled = [pkg for pkg in missing if pkg not in closures]
+        if not_bundled:
+            print(f'{WARNING}WARNING: the bundle lacks the packages: {" ".join(not_bundled)}{RESET}')
+        needed = {name for pkg in missing for name in closures.get(pkg, ())} - installed
+        files = {file for file, name in bundle.index.get('packages', {}).items() if name in needed}
+        with bundle.unpacked('packages', files) as pkg_dir:
+            paths = [str(path) for path in sorted(pkg_dir.iterdir())]
+            returncode = privileged().install_packages(pkg_mngr, paths, verbose) if paths else 0
+    else:
+        returncode = privileged().install_packages(pkg_mngr, missing, verbose)
+    if returncode != 0:
+        # fail the step, so it isn't recorded as done, and runs again on resume
+        raise RuntimeError(f'{pkg_mngr} could not install all packages (exit code {returncode}), see its output above')
+
+
+def canonical_name(name: str) -> str:
+    """ Normalize a Python package name, the way wheel file names do. """
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+class Wheelhouse:
+    """
+    A persistent directory of wheels, to install pip packages from without asking the package index.
+
+    The requested packages are resolved once into a lock, that pins every package (including dependencies) to a version
+    and an artifact. Wheels of the lock are downloaded, sdists are built into wheels, several at once. Later installs of
+    the same requests only need the lock and the wheels, so they don't touch the network at all.
+
+    A lock is only replaced when `refresh` is set (``setup.py --refresh-pip``), so new releases of unpinned requests are
+    picked up only then.
+    """
+
+    root: Path
+    downloader: DownloadManager
+    jobs: int
+    refresh: bool
+
+    def __init__(self,
+                 root: Optional[Path] = None,
+                 downloader: Optional[DownloadManager] = None,
+                 jobs: Optional[int] = None,
+                 refresh: bool = False):
+        """
+        :param root: Where to keep the wheels and locks. Defaults to ``$XDG_CACHE_HOME/dotfiles-setup/wheels``.
+        :param downloader: The download manager to fetch wheels with. A new one is used if not set.
+        :param jobs: Maximum number of sdists to build at once. Defaults to the number of CPUs.
+        :param refresh: Resolve the requests again when installing, even if there's a lock already.
+        """
+        self.root = root if root is not None else get_cache_dir() / 'wheels'
+        self.downloader = downloader if downloader is not None else DownloadManager()
+        self.jobs = jobs if jobs is not None else os.cpu_count() or 1
+        self.refresh = refresh
+
+    def install(self, pkgs: Iterable[str], verbose: bool = False) -> None:
+        """ Install packages, and everything they depend on, from the wheelhouse, adding missing wheels first. """
+        locked = self.lock(pkgs, verbose, refresh=self.refresh)
+        self.build(locked, verbose)
+        run([sys.executable, '-m', 'pip', 'install', '--no-index', '--find-links', str(self.root),
+             *(f'{pkg["name"]}=={pkg["version"]}' for pkg in locked)],
+            check=True, stdout=None if verbose else DEVNULL)
+
+    def lock(self, pkgs: Iterable[str], verbose: bool = False, refresh: bool = False) \
+            -> List[Dict[str, Optional[str]]]:
+        """
+        Resolve packages into pinned artifacts, or return the lock of a previous resolution of the same packages.
+
+        :param pkgs: Requirements, as passed to pip.
+        :param verbose: Whether to show pip output.
+        :param refresh: Resolve again, even if there's a lock already.
+        :return: Name, version, URL and (if known) SHA-256 checksum of the artifact, of every package to install.
+        """
+        pkgs = sorted(pkgs)
+        lock_path = self.root / f'lock-{fingerprint(pkgs, sys.version, sys.platform)[:16]}.json'
+        locked = read_json(lock_path) if not refresh else None
+        if locked is not None:
+            return locked
+
+        print(f'{INFO}INFO: resolving {len(pkgs)} pip packages.{RESET}')
+        self.root.mkdir(parents=True, exist_ok=True)
+        with TemporaryDirectory() as tmp:
+            report_path = Path(tmp) / 'report.json'
+            run([sys.executable, '-m', 'pip', 'install', '--dry-run', '--ignore-installed', '--quiet',
+                 '--report', str(report_path), *pkgs], check=True, stdout=None if verbose else DEVNULL)
+            with report_path.open() as report_file:
+                report = load_json(report_file)
+
+        locked = []
+        for item in report['install']:
+            info = item['download_info']
+            url = info['url']
+            if 'vcs_info' in info:
+                url = f'{info["vcs_info"]["vcs"]}+{url}@{info["vcs_info"]["commit_id"]}'
+            archive = info.get('archive_info', {})
+            checksum = archive.get('hashes', {}).get('sha256')
+            if checksum is None and archive.get('hash', '').startswith('sha256='):
+                checksum = archive['hash'].removeprefix('sha256=')
+            locked.append({
+                'name': item['metadata']['name'],
+                'version': item['metadata']['version'],
+                'url': url,
+                'sha256': checksum,
+            })
+
+        write_json_atomic(lock_path, locked)
+        return locked
+
+    def build(self, locked: List[Dict[str, Optional[str]]], verbose: bool = False) -> None:
+        """
+        Add the wheels of a lock, that aren't in the wheelhouse yet. Wheels are downloaded, anything else is built.
+
+        :raise ValueError: If a downloaded wheel doesn't match its checksum.
+        """
+        present = set()
+        for wheel in self.root.glob('*.whl'):
+            name, version = wheel.name.split('-')[:2]
+            present.add((canonical_name(name), version))
+        missing = [pkg for pkg in locked if (canonical_name(pkg['name']), pkg['version']) not in present]
+        if not missing:
+            return
+
+        downloads = [pkg for pkg in missing if urlsplit(pkg['url']).path.endswith('.whl')]
+        builds = [pkg for pkg in missing if pkg not in downloads]
+        print(f'{INFO}INFO: adding {len(missing)} wheels to the wheelhouse, {len(builds)} of them are built.{RESET}')
+
+        def download(pkg: Dict[str, Optional[str]]) -> None:
+            url = urlsplit(pkg['url'])
+            name = Path(url.path).name
+            part = self.root / f'.{name}.part'
+            if url.scheme == 'file':
+                # pip may be configured to find packages in local directories
+                copyfile(url2pathname(url.path), part)
+                if pkg['sha256'] is not None and (actual := file_digest(part)) != pkg['sha256']:
+                    part.unlink()
+                    raise ValueError(f'Checksum mismatch for {pkg["url"]}: expected {pkg["sha256"]}, got {actual}')
+            else:
+                with self.downloader.open(pkg['url'], pkg['sha256']) as stream, part.open('wb') as part_file:
+                    copyfileobj(stream, part_file)
+            part.replace(self.root / name)
+
+        def build(pkg: Dict[str, Optional[str]]) -> None:
+            # building happens in a separate directory, so a half written wheel never shows up in the wheelhouse
+            with TemporaryDirectory(dir=self.root) as tmp:
+                run([sys.executable, '-m', 'pip', 'wheel', '--no-deps', '--wheel-dir', tmp, pkg['url']],
+                    check=True, stdout=None if verbose else DEVNULL)
+                for wheel in Path(tmp).glob('*.whl'):
+                    wheel.replace(self.root / wheel.name)
+
+        # builds are separate pip processes, so threads are enough to keep all CPUs busy
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(download, pkg) for pkg in downloads]
+            futures += [pool.submit(build, pkg) for pkg in builds]
+            for future in futures:
+                future.result()
 
 
 class PipPkgSpec(PkgSpec):
     """ Describes a set of packages to be installed via `pip`. """
 
     pkgs: Tuple[str]
+    facts: HostFacts
 
-    def __init__(self, pkgs: List[str]):
+    def __init__(self, pkgs: List[str], facts: Optional[HostFacts] = None):
         self.pkgs = tuple(pkgs)
+        self.facts = facts if facts is not None else get_host_facts()
 
-    def install(self, verbose: bool = False) -> None:
-        """ Install packages via `pip`. """
+    @profiled('install')
+    def install(self, verbose: bool = False, find_links: Optional[Path] = None) -> None:
+        """
+        Install packages via `pip`.
+
+        :param verbose: Whether to show pip output.
+        :param find_links: A directory with all package files, to install from instead of the package index.
+        """
         assert getuser() != 'root', 'Installing pip packages as root is not supported'
 
+        index_args = ['--no-index', '--find-links', str(find_links)] if find_links is not None else []
         if self.pkgs:
-            run([sys.executable, '-m', 'pip', 'install', 'wheel', 'setuptools'], **self._proc_conf(verbose))
-            pkg_proc = run([sys.executable, '-m', 'pip', 'install', *self.pkgs], **self._proc_conf(verbose))
-
-
-def get_desktop_environments() -> List[str]:
-    """ Return list of desktop environments in use. """
-    return os.getenv('XDG_CURRENT_DESKTOP', '').split(':')
-
-
-def is_kde() -> bool:
-    """ Is KDE used? Not necessarily mutually exclusive with `is_gnome`! """
-    return 'KDE' in get_desktop_environments()
-
+            if find_links is None:
+                run([sys.executable, '-m', 'pip', 'install', 'wheel', 'setuptools'], **self._proc_conf(verbose))
+            pkg_proc = run([sys.executable, '-m', 'pip', 'install', *index_args, *self.pkgs],
+                           **self._proc_conf(verbose))
+
+    def install_bundled(self, bundle: Bundle, verbose: bool = False) -> None:
+        """ Install packages via `pip`, from the package files in an offline bundle. """
+        with bundle.unpacked('wheels') as wheel_dir:
+            self.install(verbose, find_links=wheel_dir)
+
+    @profiled('install')
+    def install_wheelhouse(self, wheelhouse: Optional[Wheelhouse] = None, verbose: bool = False) -> None:
+        """ Install packages via `pip`, through a `Wheelhouse`, so reruns don't need the package index. """
+        assert getuser() != 'root', 'Installing pip packages as root is not supported'
 
-def is_gnome() -> bool:
-    """ Is GNOME used? Not necessarily mutually exclusive with `is_kde`! """
-    return 'GNOME' in get_desktop_environments()
+        if self.pkgs:
+            wheelhouse = wheelhouse if wheelhouse is not None else Wheelhouse()
+            wheelhouse.install(self.pkgs, verbose)
 
 
 class DesktopPkgSpec(PkgSpec):
@@ -239,18 +1816,27 @@ class DesktopPkgSpec(PkgSpec):
     kde_sys_pkgs: SysPkgSpec
     kde_exts: Tuple[Tuple[str, Tuple[str, ...]]]
 
-    def __init__(self, mapping: Dict[str, Dict[str, List[str]]]):
+    downloader: DownloadManager
+    facts: HostFacts
+
+    def __init__(self,
+                 mapping: Dict[str, Dict[str, List[str]]],
+                 downloader: Optional[DownloadManager] = None,
+                 facts: Optional[HostFacts] = None):
+        self.downloader = downloader if downloader is not None else DownloadManager()
+        self.facts = facts if facts is not None else get_host_facts()
+
         # GNOME and KDE are not mutually exclusive!
-        if is_gnome():
+        if self.facts.is_gnome():
             gnome = mapping.get('gnome', {})
-            self.gnome_sys_pkgs = SysPkgSpec(gnome)
+            self.gnome_sys_pkgs = SysPkgSpec(gnome, self.facts)
             self.gnome_exts = tuple(gnome.get('extensions', []))
         else:
             self.gnome_sys_pkgs = None
 
-        if is_kde():
+        if self.facts.is_kde():
             kde = mapping.get('kde', {})
-            self.kde_sys_pkgs = SysPkgSpec(kde)
+            self.kde_sys_pkgs = SysPkgSpec(kde, self.facts)
             self.kde_exts = tuple(
                 (ext_type, tuple(url_list))
                 for ext_type, url_list
@@ -259,69 +1845,74 @@ class DesktopPkgSpec(PkgSpec):
         else:
             self.kde_sys_pkgs = None
 
+    @profiled('install')
     def install(self, verbose: bool = False) -> None:
         """ Install the DE specific system packages and the DE extensions. """
-        dl_dst = os.getenv('XDG_DOWNLOAD_DIR', os.getenv('HOME') + '/Downloads')
-        dl_dir = clean_path(dl_dst)
+        install_system_packages(self.sys_pkg_specs(), verbose)
+        self.install_extensions(verbose)
 
-        self._install_gnome(dl_dir, verbose)
-        self._install_kde(dl_dir, verbose)
+    def sys_pkg_specs(self) -> List[SysPkgSpec]:
+        """ Return the system package specs of the desktop environments in use. """
+        return [spec for spec in (self.gnome_sys_pkgs, self.kde_sys_pkgs) if spec is not None]
 
-    def _install_kde(self, dl_dir: Path, verbose: bool = False) -> None:
-        """ Install KDE specific programs and extensions. """
-        if self.kde_sys_pkgs is not None:
-            self.kde_sys_pkgs.install(verbose)
+    def extensions(self) -> Dict[str, Union[Tuple[str, ...], Tuple[Tuple[str, Tuple[str, ...]], ...]]]:
+        """ Return the extensions to install for the desktop environments in use. """
+        return {
+            'gnome': self.gnome_exts if self.gnome_sys_pkgs is not None else (),
+            'kde': self.kde_exts if self.kde_sys_pkgs is not None else (),
+        }
+
+    def install_extensions(self, verbose: bool = False) -> None:
+        """ Install the DE extensions only, assuming the DE specific system packages are installed already. """
+        self._install_gnome(verbose)
+        self._install_kde(verbose)
 
+    def _install_kde(self, verbose: bool = False) -> None:
+        """ Install KDE specific extensions. """
+        if self.kde_sys_pkgs is not None:
             # For installing KDE extensions, I have to download the tar balls,
             # and then use `plasmapkg2` or `kpackagetool5` with the `--install` flag.
             # It's important to set the appropriate `--type` argument.
             if self.kde_exts:
-                for ext_type, ext_urls in self.kde_exts:
-                    for ext_url in ext_urls:
-                        out_doc = dl_dir / 'ext.tar.gz'
-                        ext_dir = dl_dir / 'ext'
-                        ext_dir.mkdir()
-
-                        dl_proc = run(['wget', f'--output-document={out_doc}', ext_url], **self._proc_conf(verbose))
-                        untar_proc = run(['tar', f'--one-top-level={ext_dir}', '-xzvf', str(out_doc)],
-                                         **self._proc_conf(verbose))
-
-                        try:
-                            inst_proc = run([
-                                'kpackagetool5',
-                                '--type', ext_type,
-                                '--install', str(next(ext_dir.glob('**/metadata.desktop')).parent)
-                            ],
-                                **self._proc_conf(verbose)
-                            )
-                        except Exception as e:
-                            raise e
-                        finally:
-                            out_doc.unlink()
-                            rmtree(ext_dir)
-
-    def _install_gnome(self, dl_dir: Path, verbose: bool = False) -> None:
-        """ Install GNOME specific programs and extensions. """
+                ext_list = [(ext_type, ext_url) for ext_type, ext_urls in self.kde_exts for ext_url in ext_urls]
+
+                with TemporaryDirectory() as tmp:
+                    ext_dirs = [Path(tmp) / f'ext_{i}' for i in range(len(ext_list))]
+
+                    def unpack(ext_url: str, ext_dir: Path) -> None:
+                        with self.downloader.open(ext_url) as archive:
+                            extract_tar_stream(archive, ext_dir)
+
+                    # fetch and unpack all archives at once, installing has to happen one after another though
+                    with ThreadPoolExecutor(max_workers=self.downloader.max_workers) as pool:
+                        futures = [pool.submit(unpack, ext_url, ext_dir)
+                                   for (_, ext_url), ext_dir in zip(ext_list, ext_dirs)]
+                        for future in futures:
+                            future.result()
+
+                    for (ext_type, ext_url), ext_dir in zip(ext_list, ext_dirs):
+                        inst_proc = run([
+                            'kpackagetool5',
+                            '--type', ext_type,
+                            '--install', str(next(ext_dir.glob('**/metadata.desktop')).parent)
+                        ],
+                            **self._proc_conf(verbose)
+                        )
+
+    def _install_gnome(self, verbose: bool = False) -> None:
+        """ Install GNOME specific extensions. """
         if self.gnome_sys_pkgs is not None:
-            self.gnome_sys_pkgs.install(verbose)
-
             # For installing GNOME extensions, I have to download the zip archives,
             # and then use `gnome-extensions-app install`.
             # make sure gnome-extensions-app is in $PATH
-            exts_in_path = not os.system('gnome-extensions version > /dev/null')
-            assert exts_in_path, 'Could not find gnome-extensions in $PATH'
+            assert self.facts.has('gnome-extensions'), 'Could not find gnome-extensions in $PATH'
 
             if self.gnome_exts:
-                for ext_url in self.gnome_exts:
-                    out_doc = dl_dir / 'ext.zip'
-                    try:
-                        dl_proc = run(['wget', f'--output-document={out_doc}', ext_url], **self._proc_conf(verbose))
-                        inst_proc = run(['gnome-extensions', 'install', '--force', str(out_doc)],
-                                        **self._proc_conf(verbose))
-                    except Exception as e:
-                        raise e
-                    finally:
-                        out_doc.unlink()
+                # fetch all archives at once, installing has to happen one after another though
+                out_docs = self.downloader.fetch_all([(ext_url, None) for ext_url in self.gnome_exts])
+
+                for out_doc in out_docs:
+                    run(['gnome-extensions', 'install', '--force', str(out_doc)], **self._proc_conf(verbose))
 
 
 class SetupPkgSpec(PkgSpec):
@@ -332,20 +1923,60 @@ class SetupPkgSpec(PkgSpec):
     sys_pkgs: SysPkgSpec
     de_pkgs: DesktopPkgSpec
     pip_pkgs: PipPkgSpec
-
-    def __init__(self, path: Path):
+    bundle: Optional[Bundle]
+    wheelhouse: Optional[Wheelhouse]
+    facts: HostFacts
+
+    def __init__(self,
+                 path: Path,
+                 downloader: Optional[DownloadManager] = None,
+                 wheelhouse: bool = True,
+                 facts: Optional[HostFacts] = None,
+                 refresh_pip: bool = False):
+        """
+        :param path: JSON file that specifies which packages to install.
+        :param downloader: The download manager to fetch artifacts with. A new one is used if not set.
+        :param wheelhouse: Whether to install pip packages through a `Wheelhouse`.
+        :param facts: The facts of this host. They're probed if not set.
+        :param refresh_pip: Resolve the pip packages again, instead of using the lock of the wheelhouse.
+        """
         print(f'{INFO}INFO: installing software.{RESET}')
+        self.bundle = downloader.bundle if downloader is not None else None
+        self.wheelhouse = Wheelhouse(downloader=downloader, refresh=refresh_pip) if wheelhouse else None
         with path.open() as json:
             mapping = load_json(json)
 
-        self.sys_pkgs = SysPkgSpec(mapping.get('system', {}))
-        self.de_pkgs = DesktopPkgSpec(mapping.get('desktop', {}))
-        self.pip_pkgs = PipPkgSpec(mapping.get('pip', {}))
+        self.facts = facts if facts is not None else get_host_facts()
+        self.sys_pkgs = SysPkgSpec(mapping.get('system', {}), self.facts)
+        self.de_pkgs = DesktopPkgSpec(mapping.get('desktop', {}), downloader, self.facts)
+        self.pip_pkgs = PipPkgSpec(mapping.get('pip', {}), self.facts)
 
+    @profiled('install')
     def install(self, verbose: bool = False) -> None:
-        self.sys_pkgs.install(verbose)
-        self.de_pkgs.install(verbose)
-        self.pip_pkgs.install(verbose)
+        graph = TaskGraph()
+        self.add_tasks(graph, verbose)
+        graph.run()
+
+    def add_tasks(self, graph: TaskGraph, verbose: bool = False) -> None:
+        """
+        Register the install steps with a task graph. All system packages, including the DE specific ones, are
+        installed in one transaction. DE extensions and pip packages don't depend on each other, but both need the
+        system packages (e.g. ``gnome-extensions``, and the system python respectively).
+        """
+        sys_specs = [self.sys_pkgs, *self.de_pkgs.sys_pkg_specs()]
+        graph.add('system', lambda: install_system_packages(sys_specs, verbose, self.bundle),
+                  fingerprint=lambda: fingerprint([spec.pkgs for spec in sys_specs]))
+        graph.add('desktop', lambda: self.de_pkgs.install_extensions(verbose), depends=('system',),
+                  fingerprint=lambda: fingerprint(self.de_pkgs.extensions()))
+        if self.bundle is not None:
+            graph.add('pip', lambda: self.pip_pkgs.install_bundled(self.bundle, verbose), depends=('system',),
+                      fingerprint=lambda: fingerprint(self.pip_pkgs.pkgs))
+        elif self.wheelhouse is not None:
+            graph.add('pip', lambda: self.pip_pkgs.install_wheelhouse(self.wheelhouse, verbose), depends=('system',),
+                      fingerprint=lambda: fingerprint(self.pip_pkgs.pkgs))
+        else:
+            graph.add('pip', lambda: self.pip_pkgs.install(verbose), depends=('system',),
+                      fingerprint=lambda: fingerprint(self.pip_pkgs.pkgs))
 
 
 def get_os_release() -> Dict[str, str]:
@@ -396,64 +2027,240 @@ class RepoRootManager(PathManager):
         super().__init__(repo_root)
 
 
-def git_lfs_pull() -> None:
-    """Make sure git-lfs is installed and pull files."""
+@lru_cache(maxsize=None)
+def get_repo_root() -> Path:
+    """
+    Return the root of the ``.dotfiles`` repo. Unlike `RepoRootManager`, this doesn't change the working directory,
+    which is shared between all threads, so it's safe to use from concurrently running setup steps. The root is only
+    looked up once.
+    """
+    return Path(run(
+        ['git', 'rev-parse', '--show-toplevel'],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).parent,
+    ).stdout[:-1])
+
+
+@profiled('git')
+def git_lfs_pull(include: Iterable[str] = (), offline: bool = False) -> None:
+    """
+    Make sure git-lfs is installed and pull files.
+
+    :param include: Only pull the files below these paths, relative to the repo root. Pulls everything if empty.
+    :param offline: Only check out the files already in the local LFS store, instead of pulling them.
+    """
     print(f'{INFO}INFO: making sure git-lfs is installed{RESET}')
-    assert not os.system('git lfs version > /dev/null'), 'Could not find git lfs'
+    assert get_host_facts().has('git-lfs'), 'Could not find git lfs'
 
-    with RepoRootManager():
-        print(f'{INFO}INFO: pull LFS files{RESET}')
-        run(['git', 'lfs', 'pull'], check=True)
+    if offline:
+        print(f'{INFO}INFO: check out LFS files{RESET}')
+        run(['git', 'lfs', 'checkout', *(f'{path}/**' for path in include)], check=True, cwd=get_repo_root())
+        return
 
+    print(f'{INFO}INFO: pull LFS files{RESET}')
+    include_args = ['--include', ','.join(f'{path}/**' for path in include)] if include else []
+    run(['git', 'lfs', 'pull', *include_args], check=True, cwd=get_repo_root())
 
-def git_update_submodules() -> None:
-    """Initialize and update git submodules."""
-    with RepoRootManager():
-        print(f"{INFO}INFO: Initializing git submodules.{RESET}")
-        run(['git', 'submodule', 'update', '--init', '--recursive'], check=True)
 
+@profiled('git')
+def git_update_submodules(jobs: int = 8, offline: bool = False) -> None:
+    """
+    Initialize and update git submodules, fetching several of them at once, and without their history.
 
+    :param offline: Only check out commits that were fetched before, instead of fetching them.
+    """
+    print(f"{INFO}INFO: Initializing git submodules.{RESET}")
+    fetch_args = ['--no-fetch'] if offline else ['--jobs', str(jobs), '--depth', '1']
+    run(['git', 'submodule', 'update', '--init', '--recursive', *fetch_args], check=True, cwd=get_repo_root())
+
+
+@profiled('git')
 def git_set_origin(url: str = 'git@github.com:FynnFreyer/.dotfiles') -> None:
     """Enable SSH authentication by setting the origin."""
-    with RepoRootManager():
-        run(['git', 'remote', 'set-url', 'origin', url], check=True)
+    run(['git', 'remote', 'set-url', 'origin', url], check=True, cwd=get_repo_root())
+
 
+def git_fingerprint() -> str:
+    """ Return a digest of the state that `git_setup` depends on. """
+    repo_root = get_repo_root()
+    head = run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=repo_root).stdout
+    return fingerprint(head, repo_root / '.gitmodules', repo_root / '.gitattributes')
 
-def git_setup() -> None:
-    """Make sure the ``.dotfiles`` repo is properly setup."""
-    git_update_submodules()
-    git_lfs_pull()
+
+def git_setup(stow_pkg_path: Optional[Path] = None, jobs: int = 8, offline: bool = False) -> None:
+    """
+    Make sure the ``.dotfiles`` repo is properly setup.
+
+    LFS files are pulled while the submodules are updated. The origin is set to the SSH URL after both finished:
+    the SSH keys come from an LFS file, so LFS has to pull over the URL the repo was cloned with. Initializing
+    submodules writes to ``.git/config`` too, so this also keeps the writes apart.
+
+    Offline, only what the clone already contains is checked out. Submodules or LFS files missing from it are reported,
+    but don't fail the step, so the packages can still be stowed.
+
+    :param stow_pkg_path: JSON file listing the packages to stow. If passed, only their LFS files are pulled.
+    :param jobs: How many submodules to fetch at once.
+    :param offline: Don't touch the network, e.g. when installing from a bundle.
+    """
+    start = perf_counter()
+    get_repo_root()
+
+    include = ()
+    if stow_pkg_path is not None:
+        with stow_pkg_path.open() as stow_pkg_file:
+            include = tuple(json.load(stow_pkg_file))
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = {
+            'submodules': pool.submit(git_update_submodules, jobs, offline),
+            'LFS files': pool.submit(git_lfs_pull, include, offline),
+        }
+        for what, future in futures.items():
+            try:
+                future.result()
+            except (CalledProcessError, AssertionError) as error:
+                if not offline:
+                    raise
+                print(f'{WARNING}WARNING: could not check out the {what} without network access: {error}{RESET}')
     git_set_origin()
 
+    print(f'{INFO}INFO: git setup took {perf_counter() - start:.1f}s.{RESET}')
+
+
+class KeePassSession:
+    """
+    An interactive ``keepassxc-cli open`` session, driven over a pseudo terminal, so the database is unlocked only once
+    for any number of commands. Unlocking derives the key with Argon2, which takes about a second every time.
+
+    The CLI doesn't mark the end of a command's output, so every command is followed by a sentinel command, that the
+    CLI rejects as unknown. Everything before that rejection is the output of the command.
+    """
+
+    db: Path
+    timeout: float
+
+    def __init__(self, db: Union[str, Path], timeout: float = 60):
+        self.db = clean_path(db)
+        self.timeout = timeout
+        self._proc: Optional[Popen] = None
+        self._master: Optional[int] = None
+        self._commands = 0
+
+    def unlock(self, password: str) -> bool:
+        """ Open the database, and return whether the password was correct. Closes any previous session. """
+        self.close()
+        self._master, slave = openpty()
+        # the password is typed in, so don't echo the input back
+        attrs = tcgetattr(slave)
+        attrs[3] &= ~ECHO
+        tcsetattr(slave, TCSANOW, attrs)
+        # exported attachments are secrets, so only the user may read them
+        self._proc = Popen(['keepassxc-cli', 'open', str(self.db)], stdin=slave, stdout=slave, stderr=slave,
+                           cwd=Path.home(), start_new_session=True, umask=0o077)
+        os.close(slave)
+
+        try:
+            # the CLI discards input typed ahead of the prompt, when it turns off echo
+            self._read_until(b'password')
+            self._write(password)
+            # same when it turns echo back on, so wait for the prompt before sending the next command
+            output = self._read_until(b'> ').decode(errors='replace')
+        except (EOFError, OSError):
+            self.close()
+            return False
+        if 'Invalid credentials' in output or 'Error while reading the database' in output:
+            self.close()
+            return False
+        return True
+
+    def export_attachment(self, entry: str, attachment: str, dst: Path) -> None:
+        """
+        Export an attachment of an entry to a file, readable by the user only.
+
+        :raise RuntimeError: If exporting failed.
+        """
+        output = self.command('attachment-export', entry, attachment, str(dst))
+        if 'Successfully exported' not in output:
+            raise RuntimeError(f'Exporting {attachment} of {entry} failed: {output.strip()}')
+        # keepassxc-cli keeps the mode of files that exist already
+        dst.chmod(0o600)
+
+    def command(self, *args: str) -> str:
+        """ Run a command in the session, and return its output. Without `args`, only the pending output is read. """
+        if args:
+            self._write(' '.join('"' + arg.replace('\\', '\\\\').replace('"', '\\"') + '"' for arg in args))
+        self._commands += 1
+        sentinel = f'__end_of_output_{self._commands}__'
+        self._write(sentinel)
+        return self._read_until(f'Unknown command {sentinel}'.encode()).decode(errors='replace')
+
+    def close(self) -> None:
+        """ Quit the session. """
+        if self._proc is not None:
+            try:
+                self._write('quit')
+                self._proc.wait(timeout=5)
+            except (OSError, TimeoutExpired):
+                self._proc.kill()
+                self._proc.wait()
+            os.close(self._master)
+            self._proc = self._master = None
+
+    def _read_until(self, marker: bytes) -> bytes:
+        """ Read output up to `marker` (case-insensitive), and return everything before it. """
+        output = b''
+        while marker.lower() not in output.lower():
+            ready, _, _ = select([self._master], [], [], self.timeout)
+            if not ready:
+                raise RuntimeError(f'keepassxc-cli did not answer within {self.timeout}s')
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                # reading the master end fails, once the CLI exited
+                chunk = b''
+            if not chunk:
+                raise EOFError('keepassxc-cli exited')
+            output += chunk
+        return output[:output.lower().index(marker.lower())]
+
+    def _write(self, line: str) -> None:
+        os.write(self._master, line.encode() + b'\n')
+
+    def __enter__(self) -> KeePassSession:
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
 
 def install_keepass_attachments(db: Union[str, Path], attachments: Tuple[Tuple[str, str, Union[str, Path]], ...]):
     """
-    Installs attachments from a KeePassXC database into the file system.
+    Installs attachments from a KeePassXC database into the file system. The database is unlocked only once, and the
+    exported files are only readable by the user.
 
     :param db: Path to the database
     :param attachments: Tuple of (attachment_path, attachment_name, attachment_destination).
     """
     print(f"{INFO}INFO: Installing SSH keys.{RESET}")
-    db = quote(str(clean_path(db)))
 
-    with PathManager(Path.home()):
+    with KeePassSession(db) as session:
         while True:
-            password = quote(getpass(f'Need access to KeePassXC database {db} to export attachments.\n'
-                                     f'Please provide the password: '))
-            if os.system(f'echo {password} | keepassxc-cli ls {db} 2>&1 > /dev/null') != 0:
-                print(f'{WARNING}Incorrect password, please try again.{RESET}')
-            else:
+            password = getpass(f'Need access to KeePassXC database {session.db} to export attachments.\n'
+                               f'Please provide the password: ')
+            unlocked = session.unlock(password)
+            del password
+            if unlocked:
                 break
+            print(f'{WARNING}Incorrect password, please try again.{RESET}')
 
         for attachment_path, attachment_name, attachment_destination in attachments:
             dst = clean_path(attachment_destination)
             if dst.is_dir():
                 dst /= attachment_name
 
-            run(['keepassxc-cli', 'attachment-export', str(db), attachment_path, attachment_name, str(dst)],
-                input=password + '\n', text=True, check=True)
-
-        del password
+            session.export_attachment(attachment_path, attachment_name, dst)
 
 
 def secure_and_add_ssh_keys():
@@ -482,7 +2289,189 @@ def secure_and_add_ssh_keys():
         run(['ssh-add', *keys])
 
 
+# what `stow` ignores, if a package has no `.stow-local-ignore`
+_default_stow_ignore = r"""
+RCS
+.+,v
+CVS
+\.\#.+
+\.cvsignore
+\.svn
+_darcs
+\.hg
+\.git
+\.gitignore
+\.gitmodules
+.+~
+\#.*\#
+^/README.*
+^/LICENSE.*
+^/COPYING
+"""
+
+
+TargetKind = Literal['dir', 'file', 'symlink', 'other']
+
+
+class TargetIndex:
+    """
+    Cached view of a target tree for stowing, built from one `os.scandir` per directory, instead of several `stat`
+    calls per file. Directories are scanned the first time something in them is looked up. Changes made by applying a
+    `StowPlan` are recorded, so one index can be shared by all plans of a run.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._dirs: Dict[Path, Optional[Dict[str, TargetKind]]] = {}
+        self.scans = 0
+        self.entries = 0
+        self.lookups = 0
+
+    def lookup(self, path: Path) -> Optional[TargetKind]:
+        """ Return what kind of thing is at a path (without following a symlink there), or None if nothing is. """
+        with self._lock:
+            self.lookups += 1
+            listing = self._listing(path.parent)
+            return listing.get(path.name) if listing is not None else None
+
+    def update(self, path: Path, kind: Optional[TargetKind]) -> None:
+        """ Record a change to the target tree. """
+        with self._lock:
+            listing = self._dirs.get(path.parent)
+            if listing is not None:
+                if kind is None:
+                    listing.pop(path.name, None)
+                else:
+                    listing[path.name] = kind
+            if kind == 'dir':
+                self._dirs[path] = {}
+            else:
+                self._dirs.pop(path, None)
+
+    def report(self) -> None:
+        """ Print how many ``stat`` calls the index saved, compared to checking every target path on its own. """
+        # checking exists, is_file, is_symlink and resolve for every path takes at least 4 syscalls
+        naive = 4 * self.lookups
+        print(f'{INFO}INFO: answered {self.lookups} target lookups from {self.scans} directory scans '
+              f'({self.entries} entries), saving at least {max(0, naive - self.scans)} of {naive} stat calls.{RESET}')
+
+    def _listing(self, directory: Path) -> Optional[Dict[str, TargetKind]]:
+        if directory not in self._dirs:
+            try:
+                with os.scandir(directory) as entries:
+                    self._dirs[directory] = {entry.name: self._kind(entry) for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                self._dirs[directory] = None
+            self.scans += 1
+            self.entries += len(self._dirs[directory] or ())
+        return self._dirs[directory]
+
+    @staticmethod
+    def _kind(entry: os.DirEntry) -> TargetKind:
+        # the type usually comes with the directory listing, otherwise this takes one lstat
+        if entry.is_symlink():
+            return 'symlink'
+        elif entry.is_dir(follow_symlinks=False):
+            return 'dir'
+        elif entry.is_file(follow_symlinks=False):
+            return 'file'
+        return 'other'
+
+
+class StowPlan:
+    """
+    A batch of file system operations for (un)stowing packages. Plans for several packages can be collected into a
+    single plan, that is checked for conflicts, and applied in one go.
+    """
+
+    ops: List[Tuple[Literal['mkdir', 'unlink', 'symlink', 'rmdir'], Path, Optional[str]]]
+    conflicts: List[str]
+    planned: Dict[Path, Optional[Path]]
+    index: TargetIndex
+
+    def __init__(self, index: Optional[TargetIndex] = None):
+        """
+        :param index: Index of the target tree, may be shared with other plans. A new one is used if not set.
+        """
+        self.ops = []
+        self.conflicts = []
+        # targets created by the plan, mapped to the source they link to (None for directories)
+        self.planned = {}
+        self.index = index if index is not None else TargetIndex()
+        self._new_dirs: Set[Path] = set()
+
+    def lookup(self, path: Path) -> Optional[TargetKind]:
+        """ Return what kind of thing is at a target path, or None if nothing is (or will be, once applied). """
+        if path.parent in self._new_dirs:
+            return None
+        return self.index.lookup(path)
+
+    def mkdir(self, path: Path) -> None:
+        """ Plan to create a directory. Its contents are known to be empty from here on. """
+        self.ops.append(('mkdir', path, None))
+        self.planned[path] = None
+        self._new_dirs.add(path)
+
+    def symlink(self, path: Path, source: Path) -> None:
+        """ Plan to create a relative symlink to a source. """
+        self.ops.append(('symlink', path, os.path.relpath(source, path.parent)))
+        self.planned[path] = source
+
+    def apply(self, dry_run: bool = False, verbose: bool = False) -> None:
+        """
+        Apply all operations in order.
+
+        :param dry_run: Only print the operations.
+        :param verbose: Print the operations while applying them.
+        :raise RuntimeError: If there are conflicts. Nothing is changed in that case.
+        """
+        if self.conflicts:
+            for conflict in self.conflicts:
+                print(f'{ERROR}CONFLICT: {conflict}{RESET}')
+            raise RuntimeError(f'Not stowing, because of {len(self.conflicts)} conflicts')
+
+        for op, path, link in self.ops:
+            if dry_run or verbose:
+                print(f'{INFO}{op.upper()}: {path}{f" -> {link}" if link else ""}{RESET}')
+            if dry_run:
+                continue
+            elif op == 'mkdir':
+                # another step may have created it since the plan was made, which is just as good
+                path.mkdir(exist_ok=True)
+                if not path.is_dir() or path.is_symlink():
+                    raise FileExistsError(f'{path} appeared since planning, and is not a directory')
+                self.index.update(path, 'dir')
+            elif op == 'unlink':
+                if self.index.lookup(path) != 'symlink':
+                    print(f'{WARNING}Unlinking {path}.{RESET}')
+                path.unlink()
+                self.index.update(path, None)
+            elif op == 'symlink':
+                path.symlink_to(link)
+                self.index.update(path, 'symlink')
+            elif op == 'rmdir':
+                # only directories that became empty are removed
+                try:
+                    path.rmdir()
+                except OSError:
+                    pass
+                else:
+                    self.index.update(path, None)
+
+        print(f'{INFO}INFO: {"would apply" if dry_run else "applied"} {len(self.ops)} stow operations.{RESET}')
+
+
 class StowPkgSpec(PkgSpec):
+    """
+    Describes a package of dotfiles, to be symlinked into a target directory, like ``stow --no-folding --dotfiles``
+    would do it, but without the need for ``stow`` itself.
+
+    That means, directories are always created (never symlinked), every file gets its own relative symlink, and
+    a leading ``dot-`` in a file name is replaced by ``.``. Regular files in the way are replaced by the symlink,
+    anything else that's in the way is a conflict. Files matching the patterns in ``.stow-local-ignore``, or the
+    default ignore list of ``stow``, are skipped.
+    """
+
     package_directory: Path
     target_directory: Path
 
@@ -490,66 +2479,218 @@ class StowPkgSpec(PkgSpec):
         self.package_directory = clean_path(package_directory)
         self.target_directory = clean_path(target_directory)
 
+    @profiled('install')
     def install(self, verbose: bool = False):
-        # make sure stow is in $PATH
-        assert not os.system('stow -V > /dev/null'), 'Could not find stow in $PATH'
-        self._prepare_stow()
-        with PathManager(self.package_directory.parent):
-            run([
-                'stow',
-                '--no-folding',
-                '--dotfiles',
-                '--target', str(self.target_directory),
-                str(self.package_directory.name)
-            ], check=True)
-
-    def _prepare_stow(self):
-        """
-        If a file `target`, relative to `package_directory`, also exists relative to `target_directory`, unlink the
-        `target` in `target_directory`. Don't do anything on links, or if the target resides in a linked directory
-        (i.e. `target != target.resolve()`).
-        """
-        for (dirpath, dirnames, filenames) in os.walk(self.package_directory):
-            for name in filenames:
-                current = Path(dirpath) / name
-                relative = current.relative_to(self.package_directory)
-                target = self.target_directory / relative
-                # is_file is unnecessary, because we iterate over filenames already, but look at it as a sanity check
-                # (e.g. in case we change what we iterate over)
-                if target.exists() and target.is_file() and not target.is_symlink() and target == target.resolve():
-                    print(f'{WARNING}Unlinking {target}.{RESET}')
-                    target.unlink()
+        stow([self], verbose=verbose)
+
+    def uninstall(self, verbose: bool = False):
+        stow([self], unstow=True, verbose=verbose)
+
+    def _prepare_stow(self, plan: StowPlan) -> None:
+        """ Add the operations for stowing this package to a plan. """
+        for source, target, is_dir in self._scan():
+            if target in plan.planned:
+                # another package already claimed the target, that's fine for directories only
+                if not (is_dir and plan.planned[target] is None):
+                    plan.conflicts.append(f'{target} is claimed by {plan.planned[target] or "a directory"} and {source}')
+                continue
+
+            kind = plan.lookup(target)
+            if is_dir:
+                if kind is None:
+                    plan.mkdir(target)
+                elif kind == 'symlink' and self._links_to(target, source):
+                    # folded by a previous stow run, unfold it
+                    plan.ops.append(('unlink', target, None))
+                    plan.mkdir(target)
+                elif kind != 'dir':
+                    plan.conflicts.append(f'{target} is in the way of directory {source}')
+            else:
+                if kind is None:
+                    plan.symlink(target, source)
+                elif kind == 'symlink':
+                    if not self._links_to(target, source):
+                        plan.conflicts.append(f'{target} is a symlink to {os.readlink(target)}, not {source}')
+                elif kind == 'file':
+                    plan.ops.append(('unlink', target, None))
+                    plan.symlink(target, source)
+                else:
+                    plan.conflicts.append(f'{target} is in the way of file {source}')
+
+    def _prepare_unstow(self, plan: StowPlan) -> None:
+        """ Add the operations for unstowing this package to a plan. """
+        dirs = []
+        for source, target, is_dir in self._scan():
+            kind = plan.lookup(target)
+            if is_dir:
+                if kind == 'dir':
+                    dirs.append(target)
+            elif kind == 'symlink' and self._links_to(target, source):
+                plan.ops.append(('unlink', target, None))
+
+        # innermost directories first, so their parents may become empty too
+        plan.ops.extend(('rmdir', target, None) for target in reversed(dirs))
+
+    def _scan(self) -> Iterator[Tuple[Path, Path, bool]]:
+        """
+        Walk the package once, top down, and yield (source, target, is_dir) for every entry that isn't ignored.
+        """
+        ignore_basename, ignore_path = self._ignore_patterns()
+
+        def walk(directory: Path, target_directory: Path, relative: str) -> Iterator[Tuple[Path, Path, bool]]:
+            with os.scandir(directory) as entries:
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    entry_relative = f'{relative}/{entry.name}'
+                    if ignore_basename.fullmatch(entry.name) or ignore_path.search(entry_relative):
+                        continue
+
+                    name = '.' + entry.name[4:] if entry.name.startswith('dot-') else entry.name
+                    source, target = Path(entry.path), target_directory / name
+                    # symlinks in the package are linked to, like regular files
+                    if entry.is_dir(follow_symlinks=False):
+                        yield source, target, True
+                        yield from walk(source, target, entry_relative)
+                    else:
+                        yield source, target, False
+
+        yield from walk(self.package_directory, self.target_directory, '')
+
+    def _ignore_patterns(self) -> Tuple[re.Pattern, re.Pattern]:
+        """
+        Return regexes for ignored basenames, and ignored paths (relative to the package, with a leading slash), parsed
+        from ``.stow-local-ignore``, or the defaults of ``stow``.
+        """
+        local_ignore = self.package_directory / '.stow-local-ignore'
+        lines = local_ignore.read_text().splitlines() if local_ignore.is_file() else _default_stow_ignore.splitlines()
+
+        basename_patterns, path_patterns = [r'\.stow-local-ignore'], []
+        for line in lines:
+            # comments start with an unescaped #
+            pattern = re.sub(r'(?<!\\)#.*', '', line).strip().replace(r'\#', '#')
+            if pattern:
+                (path_patterns if '/' in pattern else basename_patterns).append(pattern)
+
+        basename_re = re.compile('|'.join(f'(?:{pattern})' for pattern in basename_patterns))
+        path_re = re.compile('|'.join(f'(?:{pattern})$' for pattern in path_patterns) or r'(?!)')
+        return basename_re, path_re
+
+    @staticmethod
+    def _links_to(link: Path, source: Path) -> bool:
+        """ Whether a symlink points to the source, either by an absolute or a relative path. """
+        return os.path.normpath(link.parent / os.readlink(link)) == os.path.normpath(source)
+
+
+@profiled('install')
+def stow(specs: Iterable[StowPkgSpec],
+         unstow: bool = False,
+         dry_run: bool = False,
+         verbose: bool = False,
+         index: Optional[TargetIndex] = None) -> None:
+    """
+    (Un)stow several packages with a single plan, that is checked for conflicts as a whole before anything changes.
+
+    :param specs: The packages.
+    :param unstow: Remove the symlinks of the packages (and directories that become empty), instead of creating them.
+    :param dry_run: Only print what would be done.
+    :param verbose: Print every operation.
+    :param index: Index of the target tree. A new one is used if not set.
+    """
+    plan = StowPlan(index)
+    for spec in specs:
+        if unstow:
+            spec._prepare_unstow(plan)
+        else:
+            spec._prepare_stow(plan)
+
+    plan.apply(dry_run=dry_run, verbose=verbose)
+    plan.index.report()
 
 
+# where the profiles of an application are listed, and where their caches live
+MOZILLA_APPS = {
+    'firefox': ('~/.mozilla/firefox', '~/.cache/mozilla/firefox'),
+    'thunderbird': ('~/.thunderbird', '~/.cache/thunderbird'),
+}
+
+
+@profiled('install')
 def install_mozilla_config():
-    """Install configuration files for Firefox and Thunderbird."""
-    install_tb_config()
-    install_ff_config()
+    """
+    Install configuration files for Firefox and Thunderbird, to every profile listed in their ``profiles.ini``. The
+    profiles are set up concurrently, and the startup cache of a profile is only deleted, if the configuration
+    deployed to it changed.
+    """
+    print(f'{INFO}INFO: installing Firefox and Thunderbird config.{RESET}')
+    profiles = [(app, *profile) for app in MOZILLA_APPS for profile in find_mozilla_profiles(app)]
+
+    manifest_path = get_state_dir() / 'mozilla.json'
+    manifest = read_json(manifest_path, {})
+
+    # one stow plan for the chrome directories of all profiles
+    chrome_specs = []
+    for app, profile_path, _ in profiles:
+        chrome_src = ASSET_DIR / app / 'profile/chrome'
+        if chrome_src.is_dir():
+            (profile_path / 'chrome').mkdir(exist_ok=True)
+            chrome_specs.append(StowPkgSpec(chrome_src, profile_path / 'chrome'))
+
+    with ThreadPoolExecutor() as pool:
+        futures = [
+            pool.submit(install_tb_config),
+            pool.submit(setup_ff_program_dir),
+            pool.submit(stow, chrome_specs, verbose=True),
+        ]
+        deployed = {
+            profile_path: pool.submit(setup_profile_dir, app, profile_path, cache_path, manifest.get(str(profile_path)))
+            for app, profile_path, cache_path in profiles
+        }
+        for future in futures:
+            future.result()
+
+    invalidated = 0
+    for profile_path, future in deployed.items():
+        content = future.result()
+        invalidated += content is not None and content != manifest.get(str(profile_path))
+        manifest[str(profile_path)] = content
+
+    write_json_atomic(manifest_path, manifest)
+
+    print(f'{INFO}INFO: configured {len(profiles)} profiles, {invalidated} needed a new startup cache.{RESET}')
+
+
+def find_mozilla_profiles(app: str) -> List[Tuple[Path, Path]]:
+    """
+    Return the directory, and the cache directory, of every profile of a Mozilla application.
+
+    :param app: The application, a key of `MOZILLA_APPS`.
+    """
+    app_dir, cache_dir = (clean_path(path) for path in MOZILLA_APPS[app])
+    config = ConfigParser()
+    if not config.read(app_dir / 'profiles.ini'):
+        print(f'{WARNING}WARNING: found no {app} profiles, start {app} once to create one.{RESET}')
+        return []
+
+    profiles = []
+    for section in config.sections():
+        opts = config[section]
+        if not section.startswith('Profile') or 'path' not in opts:
+            continue
+        if opts.get('isrelative', '1') == '1':
+            profiles.append((app_dir / opts['path'], cache_dir / opts['path']))
+        else:
+            # profiles outside of the application directory keep their cache to themselves
+            profiles.append((clean_path(opts['path']), clean_path(opts['path'])))
+    return profiles
 
 
 def install_tb_config():
     """Install configuration files for Thunderbird."""
-    print(f'{INFO}INFO: installing Thunderbird config.{RESET}')
     tb_policies = ASSET_DIR / 'thunderbird/policies.json'
     policy_target = Path('/etc/thunderbird/policies')
 
     # we're working in system directories -> this needs root
-    os.system(f'sudo mkdir -p {policy_target}')
-    os.system(f'sudo cp "{tb_policies}" "{policy_target / "policies.json"}"')
-
-
-def install_ff_config():
-    """Install configuration files for Firefox."""
-    print(f'{INFO}INFO: installing Firefox config.{RESET}')
-
-    # find userChrome.js loader
-    setup_ff_program_dir()
-    profile_name = setup_ff_profile_dir()
-
-    # delete startup cache
-    cache_path = clean_path('~/.cache/mozilla/firefox') / profile_name / 'startupCache'
-    rmtree(cache_path, ignore_errors=True)
-    cache_path.mkdir(parents=True)
+    privileged().mkdir(policy_target)
+    privileged().copyfile(tb_policies, policy_target / 'policies.json')
 
 
 def setup_ff_program_dir():
@@ -568,41 +2709,38 @@ def setup_ff_program_dir():
     ff_defaults = autoconf_dir / 'defaults'
 
     # we're working in system directories -> this needs root
-    os.system(f'sudo cp -r "{ff_defaults}" "{program_path}"')
-    os.system(f'sudo cp "{ff_config_js}" "{program_path}"')
-
+    privileged().copytree(ff_defaults, program_path / ff_defaults.name)
+    privileged().copyfile(ff_config_js, program_path / ff_config_js.name)
 
-def setup_ff_profile_dir():
-    """Install ``userChrome.css`` and userscripts to the profile folder."""
-    with clean_path('~/.mozilla/firefox/profiles.ini').open() as profiles_file:
-        config = ConfigParser()
-        config.read_file(profiles_file)
 
-    for section in config.sections():
-        opts = dict(config[section])
-        if opts.get('name') == 'default-release':
-            profile_name = opts['path']
-            profile_path = clean_path('~/.mozilla/firefox') / profile_name
-            break
-    else:
-        # TODO error message profile folder not found
-        raise RuntimeError
+def setup_profile_dir(app: str, profile_path: Path, cache_path: Path, deployed: Optional[str] = None) -> Optional[str]:
+    """
+    Install ``user.js`` of an application to one of its profiles, and reset the startup cache of the profile if its
+    files changed. The ``chrome`` directory is stowed by `install_mozilla_config`, for all profiles at once.
+
+    :param app: The application, its profile files are taken from ``assets/<app>/profile``.
+    :param profile_path: The profile directory.
+    :param cache_path: The cache directory of the profile, containing the ``startupCache``.
+    :param deployed: Digest of the profile files that were installed last time, if any.
+    :return: Digest of the installed profile files, or None if the application has none.
+    """
+    profile_src = ASSET_DIR / app / 'profile'
+    if not profile_src.is_dir():
+        return None
 
     # symlink user prefs
-    userJS_src = ASSET_DIR / 'firefox/profile/user.js'
+    userJS_src = profile_src / 'user.js'
     userJS_dest = profile_path / 'user.js'
-    userJS_dest.unlink(missing_ok=True)
-    userJS_dest.symlink_to(userJS_src)
+    if userJS_src.is_file() and not (userJS_dest.is_symlink() and Path(os.readlink(userJS_dest)) == userJS_src):
+        userJS_dest.unlink(missing_ok=True)
+        userJS_dest.symlink_to(userJS_src)
 
-    # create chrome directory
-    chrome_dest = profile_path / 'chrome'
-    chrome_dest.mkdir(exist_ok=True)
-
-    # symlink user chrome
-    chrome_src = ASSET_DIR / 'firefox/profile/chrome'
-    StowPkgSpec(chrome_src, chrome_dest).install(verbose=True)
-
-    return profile_name
+    # the startup cache holds compiled scripts and styles, only throw it away if they changed
+    content = fingerprint(profile_src)
+    if content != deployed:
+        rmtree(cache_path / 'startupCache', ignore_errors=True)
+        (cache_path / 'startupCache').mkdir(parents=True)
+    return content
 
 
 # TODO move to file in assets directory
@@ -628,25 +2766,34 @@ StartupNotify=true
 """)
 
 
+@profiled('install')
 def install_ide(name: str,
                 long_name: str | None = None,
                 url: str | None = None,
+                sha256: str | None = None,
                 ide_home: str | None = None,
                 overwrite: bool = False,
                 mime_types: list[str] | None = None,
                 categories: list[str] | None = None,
-                desktop_file_template: Template = _desktop_file_template):
+                desktop_file_template: Template = _desktop_file_template,
+                downloader: DownloadManager | None = None,
+                register: bool = True) -> Tuple[Dict[Path, Path], Dict[Path, str]]:
     """
     Install a JetBrains IDE. Can take a URL to a tar archive.
 
     :param name: The short name used in the archive, e.g., "idea". I could probably find it programatically, but I'm lazy.
     :param long_name: Canonical name of the IDE, e.g., "IntelliJ IDEA". Defaults to the capitalized name if not set.
     :param url: A link to the tar archive to install. Assumed to be downloaded already if not provided.
+    :param sha256: Optionally the SHA-256 checksum of the archive, to verify the download.
     :param overwrite: Whether data in ide_home should be overwritten if url was passed. Defaults to False.
     :param ide_home: Where the IDE files are (or where to put them if url is passed). Defaults to f"~/.local/opt/jetbrains/{name}". IDE is then installed by symlinking to "~/.local/bin".
     :param mime_types: Optionally a list of mimetypes to associate the IDE with. E.g. "text/html"
     :param categories: Optionally a list of registered freedesktop.org categories to associate the IDE with. E.g. "WebDevelopment".
     :param desktop_file_template: A template for the .desktop file. Can use the other parameters as variables.
+    :param downloader: The download manager to fetch the archive with. A new one is used if not set.
+    :param register: Whether to link the IDE and write its .desktop file right away. Otherwise, that's left to the
+        caller, to register several IDEs in one batch with `register_desktop_entries`.
+    :return: The symlinks (link path to target) and desktop entries (path to content) that register the IDE.
     :raise FileNotFoundError: If no url was passed and ide_home doesn't exist.
     """
 
@@ -655,27 +2802,15 @@ def install_ide(name: str,
     long_name = long_name if long_name is not None else name.capitalize()
     mime_types = mime_types if mime_types is not None else []
     categories = categories if categories is not None else []
+    downloader = downloader if downloader is not None else DownloadManager()
 
     print(f'{INFO}INFO: installing IDE {long_name}.{RESET}')
 
     if url and (not ide_home.exists() or overwrite):
-        # ensure clean state
-        if ide_home.exists():
-            rmtree(ide_home)
-        ide_home.mkdir(parents=True)
-
-        # download and unpack tar archive
-        with TemporaryDirectory() as tmp:
-            tmp_dir = Path(tmp)
-            tmp_dl = tmp_dir / 'file.tar.gz'
-            urlretrieve(url, tmp_dl)
-
-            # copy archive content to ide_home
-            with taropen(tmp_dl, 'r:gz') as tarfile:
-                # the archive contains a top level folder that we need to find
-                folder = tmp_dir / tarfile.next().name.split('/')[0]
-                tarfile.extractall(tmp_dir, filter='data')
-                copytree(folder, ide_home, dirs_exist_ok=True)
+        # unpack the tar archive while it's downloading (or read from the cache), and swap it in once complete
+        # the archive contains a top level folder that we don't want
+        with staged_directory(ide_home) as staging, downloader.open(url, sha256) as archive:
+            extract_tar_stream(archive, staging, strip=1)
 
     elif url and ide_home.exists() and not overwrite:
         print(f'{WARNING}WARNING: passed a URL without specifying overwrite, but "{ide_home}" exists: '
@@ -686,8 +2821,10 @@ def install_ide(name: str,
         raise FileNotFoundError(f'ERROR: "{ide_home}" does not exist, but no url was passed. Aborting.')
 
     # install, by linking to ~/.local/bin/
-    run(['ln', '-srf', str(ide_home / f'bin/{name}'), str(home / '.local/bin/')], check=True)
-    run(['ln', '-srf', str(ide_home / f'bin/{name}.svg'), str(home / '.local/share/icons/')], check=True)
+    links = {
+        home / f'.local/bin/{name}': ide_home / f'bin/{name}',
+        home / f'.local/share/icons/{name}.svg': ide_home / f'bin/{name}.svg',
+    }
 
     category_string = ';'.join(categories)
     mime_type_string = ';'.join(mime_types)
@@ -701,25 +2838,452 @@ def install_ide(name: str,
     )
 
     desktop_file_path = Path.home() / f'.local/share/applications/{name}.desktop'
+    entries = {desktop_file_path: content}
 
-    with open(desktop_file_path, 'w') as desktop_file:
-        desktop_file.write(content)
+    if register:
+        register_desktop_entries(links, entries)
+    return links, entries
 
 
-def main(args):
-    """ Install everything. """
-    setup_spec = SetupPkgSpec(args.packages)
-    # setup_spec.install(args.verbose)
+def register_desktop_entries(links: Dict[Path, Path], entries: Dict[Path, str]) -> None:
+    """
+    Create the symlinks and desktop entries of a batch of applications, and refresh the desktop database once for the
+    whole batch. Only links and files that changed are touched, and the database is only refreshed if something did
+    change. The entries refer to their icons by absolute path, so there's no icon cache to refresh.
 
-    print(f'{INFO}INFO: setting up git remote.{RESET}')
-    git_setup()
+    :param links: Maps the path of every symlink to create to its target. The links are relative, like ``ln -sr``
+        would create them.
+    :param entries: Maps the path of every desktop entry to its content.
+    """
+    changed_dirs = set()
+    changed = 0
+    for link, target in links.items():
+        relative_target = os.path.relpath(target, link.parent)
+        if link.is_symlink() and os.readlink(link) == relative_target:
+            continue
+        link.parent.mkdir(parents=True, exist_ok=True)
+        tmp_link = link.with_name(f'.{link.name}.{os.getpid()}')
+        tmp_link.unlink(missing_ok=True)
+        tmp_link.symlink_to(relative_target)
+        tmp_link.replace(link)
+        changed_dirs.add(link.parent)
+        changed += 1
+
+    for path, content in entries.items():
+        if path.is_file() and file_digest(path) == sha256(content.encode()).hexdigest():
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}')
+        tmp_path.write_text(content)
+        tmp_path.replace(path)
+        changed_dirs.add(path.parent)
+        changed += 1
+
+    print(f'{INFO}INFO: registered {len(entries)} desktop entries, '
+          f'{changed} of {len(links) + len(entries)} links and files changed.{RESET}')
+
+    entry_dirs = {path.parent for path in entries} & changed_dirs
+    if entry_dirs and which('update-desktop-database') is not None:
+        run(['update-desktop-database', '-q', *map(str, sorted(entry_dirs))], check=True)
+
+
+def download_system_packages(pkg_mngr: str, pkgs: Iterable[str], dest: Path, verbose: bool = False) \
+        -> Tuple[Dict[str, List[str]], Dict[str, str]]:
+    """
+    Download package files for system packages and everything they depend on, without installing them.
+
+    :param pkg_mngr: Either "apt" or "dnf".
+    :param pkgs: Packages to download.
+    :param dest: Where to put the package files.
+    :param verbose: Whether to show package manager output.
+    :return: The names of the packages every requested package needs (itself included), and the name of the package
+        in every downloaded file.
+    """
+    pkgs = list(pkgs)
+    proc_conf = {} if verbose else {'stdout': DEVNULL}
+    closures: Dict[str, List[str]] = {}
+    if pkg_mngr == 'dnf':
+        proc = run(['dnf', 'download', '--resolve', '--alldeps', '--destdir', str(dest), *pkgs], **proc_conf)
+        for pkg in pkgs:
+            # requested names may be provided by a package of another name
+            providers = run(['dnf', 'repoquery', '--quiet', '--qf', '%{name}\n', '--whatprovides', pkg],
+                            capture_output=True, text=True).stdout.split()
+            requires = run(['dnf', 'repoquery', '--quiet', '--qf', '%{name}\n', '--requires', '--resolve',
+                            '--recursive', *providers], capture_output=True, text=True).stdout.split() \
+                if providers else []
+            closures[pkg] = sorted({pkg, *providers, *requires})
+
+        files = sorted(path.name for path in dest.glob('*.rpm'))
+        names = run(['rpm', '-qp', '--queryformat', '%{NAME}\n', *files], cwd=dest, capture_output=True, text=True,
+                    check=True).stdout.split() if files else []
+        packages = dict(zip(files, names))
+    else:
+        # apt-get download doesn't resolve dependencies by itself
+        depends = run(['apt-cache', 'depends', '--recurse', '--no-recommends', '--no-suggests', '--no-conflicts',
+                       '--no-breaks', '--no-replaces', '--no-enhances', *pkgs], capture_output=True, text=True)
+        # every package is listed once, followed by its indented dependencies, like "  Depends: libc6", virtual
+        # packages are in angle brackets, followed by the packages providing them, indented further
+        graph: Dict[str, Set[str]] = {}
+        current = None
+        for line in depends.stdout.splitlines():
+            if not line.strip():
+                continue
+            name = line.strip().split(': ', 1)[-1].strip('<>')
+            if line[0] != ' ':
+                current = name
+                graph.setdefault(current, set())
+            elif current is not None:
+                graph[current].add(name)
 
-    print(f'{INFO}INFO: stowing packages.{RESET}')
-    stow_pkg_path = args.stow
-    with stow_pkg_path.open() as stow_pkg_file, RepoRootManager():
-        pkgs = json.load(stow_pkg_file)
         for pkg in pkgs:
-            StowPkgSpec(pkg, '~') #.install()
+            closure, todo = set(), [pkg]
+            while todo:
+                name = todo.pop()
+                if name not in closure:
+                    closure.add(name)
+                    todo.extend(graph.get(name, ()))
+            closures[pkg] = sorted(closure)
+
+        resolved = sorted({line for line in depends.stdout.splitlines() if line and line[0] not in ' <'})
+        proc = run(['apt-get', 'download', *resolved], cwd=dest, **proc_conf)
+        # files are named like "bash_5.2.15-2_amd64.deb"
+        packages = {path.name: path.name.split('_')[0] for path in dest.glob('*.deb')}
+
+    if proc.returncode != 0:
+        # like when installing, some package names don't exist on every distro
+        print(f'{WARNING}WARNING: {pkg_mngr} could not download all packages.{RESET}')
+    return closures, packages
+
+
+def build_bundle(output: Path,
+                 packages_path: Path,
+                 ide_path: Path,
+                 fonts_path: Path,
+                 downloader: Optional[DownloadManager] = None,
+                 verbose: bool = False) -> None:
+    """
+    Download everything the setup needs into a `Bundle`, so hosts without network access can install from it. System
+    packages are downloaded for the package manager of this host, and the extensions of all desktop environments are
+    included, whichever is in use here.
+
+    :param output: Where to write the bundle.
+    :param packages_path: JSON file that specifies which packages to install.
+    :param ide_path: JSON file containing a list of IDEs to install.
+    :param fonts_path: JSON file containing a list of font archive URLs.
+    :param downloader: The download manager to fetch artifacts with. A new one is used if not set.
+    :param verbose: Whether to show package manager and pip output.
+    """
+    downloader = downloader if downloader is not None else DownloadManager()
+    facts = get_host_facts()
+    with packages_path.open() as packages_file:
+        mapping = load_json(packages_file)
+    with ide_path.open() as ide_file:
+        ides = load_json(ide_file)
+    with fonts_path.open() as fonts_file:
+        fonts = load_json(fonts_file)
+
+    desktops = mapping.get('desktop', {})
+    sys_specs = [SysPkgSpec(mapping.get('system', {}), facts)]
+    sys_specs += [SysPkgSpec(desktop, facts) for desktop in desktops.values()]
+    pkg_mngr = sys_specs[0].pkg_mngr()
+    sys_pkgs = list(dict.fromkeys(pkg for spec in sys_specs for pkg in spec.pkgs))
+    pip_pkgs = PipPkgSpec(mapping.get('pip', []), facts).pkgs
+
+    artifacts = [(ide['url'], ide.get('sha256')) for ide in ides if ide.get('url')]
+    for desktop in desktops.values():
+        exts = desktop.get('extensions', [])
+        urls = [url for url_list in exts.values() for url in url_list] if isinstance(exts, dict) else exts
+        artifacts.extend((url, None) for url in urls)
+    artifacts.extend((url, None) for url in fonts)
+    artifacts = list(dict.fromkeys(artifacts))
+
+    print(f'{INFO}INFO: bundling {len(sys_pkgs)} system packages, {len(pip_pkgs)} pip packages, '
+          f'and {len(artifacts)} downloads.{RESET}')
+
+    with TemporaryDirectory(prefix='dotfiles-bundle-') as tmp:
+        pkg_dir, wheel_dir = Path(tmp) / 'packages', Path(tmp) / 'wheels'
+        pkg_dir.mkdir()
+        wheel_dir.mkdir()
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = [
+                pool.submit(download_system_packages, pkg_mngr, sys_pkgs, pkg_dir, verbose),
+                pool.submit(run, [sys.executable, '-m', 'pip', 'download', '--dest', str(wheel_dir), *pip_pkgs],
+                            check=True, **({} if verbose else {'stdout': DEVNULL})),
+                pool.submit(downloader.fetch_all, artifacts),
+            ]
+            closures, packages = futures[0].result()
+            paths = futures[2].result()
+            for future in futures:
+                future.result()
+
+        downloads = {}
+        members = [(path, f'packages/{path.name}') for path in sorted(pkg_dir.iterdir())]
+        members += [(path, f'wheels/{path.name}') for path in sorted(wheel_dir.iterdir())]
+        for (url, _), path in zip(artifacts, paths):
+            member = f'downloads/{path.name}'
+            downloads[url] = {'member': member, 'sha256': file_digest(path), 'size': path.stat().st_size}
+            members.append((path, member))
+
+        os_release = facts.os_release
+        index = {
+            'created': time(),
+            'pkg_mngr': pkg_mngr,
+            'os': {key: os_release.get(key) for key in ('ID', 'VERSION_ID')},
+            'closures': closures,
+            'packages': packages,
+            'downloads': downloads,
+        }
+        index_path = Path(tmp) / Bundle.index_name
+        index_path.write_text(json.dumps(index, indent=2))
+
+        part = output.with_name(output.name + '.part')
+        with taropen(part, 'w') as tarfile:
+            tarfile.add(index_path, Bundle.index_name)
+            for path, member in members:
+                tarfile.add(path, member)
+        part.replace(output)
+
+    print(f'{SUCCESS}SUCCESS: wrote bundle to {output} ({output.stat().st_size / 1024 ** 3:.1f} GiB).{RESET}')
+
+
+def stow_packages(stow_pkg_path: Path,
+                  unstow: bool = False,
+                  dry_run: bool = False,
+                  verbose: bool = False,
+                  index: Optional[TargetIndex] = None) -> None:
+    """Stow (or unstow) the dotfile packages listed in a JSON file into the home directory, all in one plan."""
+    print(f'{INFO}INFO: {"unstowing" if unstow else "stowing"} packages.{RESET}')
+    repo_root = get_repo_root()
+    with stow_pkg_path.open() as stow_pkg_file:
+        pkgs = json.load(stow_pkg_file)
+    stow([StowPkgSpec(repo_root / pkg, '~') for pkg in pkgs], unstow=unstow, dry_run=dry_run, verbose=verbose,
+         index=index)
+
+
+def stow_fingerprint(stow_pkg_path: Path) -> str:
+    """ Return a digest of the files in the packages to stow. Contents don't matter, they are symlinked anyway. """
+    repo_root = get_repo_root()
+    with stow_pkg_path.open() as stow_pkg_file:
+        pkgs = json.load(stow_pkg_file)
+    listing = {
+        pkg: sorted(
+            str(Path(dirpath, name).relative_to(repo_root / pkg))
+            for dirpath, _, filenames in os.walk(repo_root / pkg)
+            for name in filenames
+        )
+        for pkg in pkgs
+    }
+    return fingerprint(listing)
+
+
+def install_ides(ide_data_path: Path, downloader: Optional[DownloadManager] = None) -> None:
+    """
+    Install the IDEs listed in a JSON file. The IDEs are installed concurrently, the download manager takes care of
+    not hammering the download server. They are registered in one batch afterwards.
+    """
+    downloader = downloader if downloader is not None else DownloadManager()
+    with ide_data_path.open() as ide_data_file:
+        # url pattern: https://download-cdn.jetbrains.com/{lang_code}/{ide_name}-{version}.tar.gz
+        data = json.load(ide_data_file)
+
+    with ThreadPoolExecutor(max_workers=downloader.max_workers) as pool:
+        futures = [pool.submit(install_ide, **ide, overwrite=False, downloader=downloader, register=False)
+                   for ide in data]
+        links, entries = {}, {}
+        for future in futures:
+            ide_links, ide_entries = future.result()
+            links.update(ide_links)
+            entries.update(ide_entries)
+
+    register_desktop_entries(links, entries)
+
+
+def get_font_dir() -> Path:
+    """ Return the directory for fonts of the user. """
+    return clean_path(os.getenv('XDG_DATA_HOME', '~/.local/share')) / 'fonts'
+
+
+@profiled('install')
+def install_fonts(fonts_path: Path,
+                  downloader: Optional[DownloadManager] = None,
+                  font_dir: Optional[Path] = None,
+                  jobs: Optional[int] = None) -> None:
+    """
+    Install the fonts of the zip archives listed in a JSON file, with the Nerd Font markers removed from their names
+    (see ``clean_nerd_font.py``). Fonts are only cleaned again, if their source, or the output written last time,
+    changed. The font cache is refreshed once, if any font changed.
+
+    Cleaning needs the ``fontforge`` Python module, and happens in a process pool, since it's CPU bound. If it can't
+    be imported, the cleaner is run by the system ``python3``, and if that lacks it as well, the fonts are installed
+    as they are.
+
+    :param fonts_path: JSON file containing a list of font archive URLs.
+    :param downloader: The download manager to fetch the archives with. A new one is used if not set.
+    :param font_dir: Where to install the fonts, every archive gets its own directory. Defaults to `get_font_dir`.
+    :param jobs: Maximum number of fonts to clean at once. Defaults to the number of CPUs.
+    """
+    print(f'{INFO}INFO: installing fonts.{RESET}')
+    downloader = downloader if downloader is not None else DownloadManager()
+    font_dir = font_dir if font_dir is not None else get_font_dir()
+    with fonts_path.open() as fonts_file:
+        urls = load_json(fonts_file)
+
+    # the worker processes find the module on the same path
+    if str(SCRIPT_DIR) not in sys.path:
+        sys.path.append(str(SCRIPT_DIR))
+    # fontforge is installed for the system Python, which may not be the one running this script
+    try:
+        from clean_nerd_font import clean_font
+        pool = ProcessPoolExecutor(max_workers=jobs, mp_context=get_context('spawn'))
+    except ImportError:
+        system_python = which('python3', path='/usr/bin:/bin')
+        if system_python and run([system_python, '-c', 'import fontforge'], stderr=DEVNULL).returncode == 0:
+            clean_font = partial(_clean_font_with, system_python)
+        else:
+            print(f'{WARNING}WARNING: fontforge is not available, installing the fonts without cleaning them.{RESET}')
+            clean_font = None
+        pool = ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+
+    manifest_path = get_state_dir() / 'fonts.json'
+    manifest = read_json(manifest_path, {})
+    # a change to the cleaning invalidates every font, and uncleaned fonts are cleaned once fontforge is there
+    cleaner = file_digest(SCRIPT_DIR / 'clean_nerd_font.py') if clean_font is not None else 'uncleaned'
+
+    archives = downloader.fetch_all([(url, None) for url in urls])
+    unchanged = 0
+    with TemporaryDirectory() as tmp, pool:
+        # fonts to install, with their cleaning, if any
+        fonts: List[Tuple[Optional[Future], Path, Path, str]] = []
+        for url, archive in zip(urls, archives):
+            dest_dir = font_dir / Path(urlsplit(url).path).stem
+            with ZipFile(archive) as zip_file:
+                for member in zip_file.infolist():
+                    check_interrupted()
+                    name = PurePosixPath(member.filename)
+                    if member.is_dir() or name.suffix.lower() not in ('.ttf', '.otf'):
+                        continue
+
+                    dest = dest_dir / name.name
+                    source = f'{member.CRC:08x}:{member.file_size}:{cleaner}'
+                    entry = manifest.get(str(dest), {})
+                    if entry.get('source') == source and dest.is_file() and file_digest(dest) == entry.get('output'):
+                        unchanged += 1
+                        continue
+
+                    # earlier fonts are cleaned, while later ones are extracted
+                    work_file = Path(tmp) / f'{len(fonts)}{name.suffix}'
+                    with zip_file.open(member) as member_file, work_file.open('wb') as out_file:
+                        copyfileobj(member_file, out_file)
+                    future = pool.submit(clean_font, str(work_file)) if clean_font is not None else None
+                    fonts.append((future, work_file, dest, source))
+
+        for future, work_file, dest, source in fonts:
+            check_interrupted()
+            if future is not None:
+                future.result()
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            # across file systems, so copy before swapping it in
+            copyfile(work_file, dest.with_name(f'.{dest.name}.part'))
+            dest.with_name(f'.{dest.name}.part').replace(dest)
+            manifest[str(dest)] = {'source': source, 'output': file_digest(dest)}
+
+    write_json_atomic(manifest_path, manifest)
+
+    print(f'{INFO}INFO: installed {len(fonts)} fonts, {unchanged} were up to date.{RESET}')
+    if fonts:
+        run(['fc-cache', str(font_dir)], check=True)
+
+
+def _clean_font_with(python: str, font_path: str) -> None:
+    """ Clean a font with ``clean_nerd_font.py``, run by another Python installation. """
+    run([python, SCRIPT_DIR / 'clean_nerd_font.py', font_path], check=True)
+
+
+def read_keyfile(content: str) -> Dict[str, Dict[str, str]]:
+    """ Parse a GNOME key file, as used by dconf, into a mapping of paths to their keys and (serialized) values. """
+    # keys are case-sensitive, and values may contain '%'
+    parser = ConfigParser(interpolation=None, strict=False)
+    parser.optionxform = str
+    parser.read_string(content)
+    return {section: dict(parser[section]) for section in parser.sections()}
+
+
+def _normalize_gvariant(value: str) -> str:
+    """ Drop whitespace outside of string literals, so formatting differences don't count as changes. """
+    parts = re.split(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""", value)
+    return ''.join(part if i % 2 else re.sub(r'\s+', '', part) for i, part in enumerate(parts))
+
+
+def dconf_delta(wanted: Dict[str, Dict[str, str]], current: Dict[str, Dict[str, str]]) \
+        -> Dict[str, Dict[str, str]]:
+    """ Return the keys of `wanted`, which are missing in or differ from `current`. """
+    delta = {}
+    for section, keys in wanted.items():
+        live = current.get(section, {})
+        changed = {key: value for key, value in keys.items()
+                   if key not in live or _normalize_gvariant(live[key]) != _normalize_gvariant(value)}
+        if changed:
+            delta[section] = changed
+    return delta
+
+
+@profiled('install')
+def load_dconf(config_path: Path, full: bool = False, verbose: bool = False) -> None:
+    """
+    Load a GNOME key file into dconf.
+
+    Unless `full` is set, only keys that differ from the current dconf database are written, so unchanged settings
+    don't fire change signals.
+    """
+    print(f'{INFO}INFO: installing dconf settings.{RESET}')
+    with config_path.open() as conf_file:
+        config = conf_file.read()
+    if full:
+        run(['dconf', 'load', '-f', '/'], text=True, check=True, input=config)
+        return
+
+    current = run(['dconf', 'dump', '/'], text=True, check=True, capture_output=True).stdout
+    delta = dconf_delta(read_keyfile(config), read_keyfile(current))
+    changes = sum(len(keys) for keys in delta.values())
+    if not changes:
+        print(f'{INFO}INFO: dconf settings are up to date.{RESET}')
+        return
+
+    if verbose:
+        for section, keys in delta.items():
+            for key, value in keys.items():
+                print(f'/{section}/{key} = {value}')
+    print(f'{INFO}INFO: changing {changes} dconf keys in {len(delta)} paths.{RESET}')
+    keyfile = ''.join(f'[{section}]\n' + ''.join(f'{key}={value}\n' for key, value in keys.items()) + '\n'
+                      for section, keys in delta.items())
+    run(['dconf', 'load', '-f', '/'], text=True, check=True, input=keyfile)
+
+
+def main(args):
+    """ Install everything. """
+    # one index for the whole run, so directories shared between packages (like `~/.config`) are only scanned once
+    stow_index = TargetIndex()
+    if args.unstow or args.dry_run:
+        stow_packages(args.stow, unstow=args.unstow, dry_run=args.dry_run, verbose=args.verbose, index=stow_index)
+        return
+
+    cache = DownloadCache(max_size=int(args.cache_size * 1024 ** 3))
+    if args.command == 'bundle':
+        output = args.bundle if args.bundle is not None else Path('dotfiles-bundle.tar')
+        build_bundle(output, args.packages, args.ide, args.fonts, DownloadManager(cache=cache), args.verbose)
+        return
+
+    # shared between all steps, so the per host connection limit holds across them
+    # a bundle is meant for hosts without network access, so don't even try
+    bundle = Bundle(args.bundle) if args.bundle is not None else None
+    downloader = DownloadManager(
+        cache=cache,
+        offline=args.cache_only or bundle is not None,
+        bundle=bundle,
+    )
+    setup_spec = SetupPkgSpec(args.packages, downloader, wheelhouse=not args.no_wheelhouse, facts=get_host_facts(),
+                              refresh_pip=args.refresh_pip)
 
     ssh_dir = clean_path('~/.ssh/')
     ssh_dir.mkdir(exist_ok=True)
@@ -736,20 +3300,42 @@ def main(args):
     #install_keepass_attachments('~/pw.kdbx', attachments)
     #secure_and_add_ssh_keys()
 
-    # # install IDEs
-    ide_data_path = args.ide
-    with ide_data_path.open() as ide_data_file:
-        # url pattern: https://download-cdn.jetbrains.com/{lang_code}/{ide_name}-{version}.tar.gz
-        data = json.load(ide_data_file)
-        for ide in data:
-            install_ide(**ide, overwrite=False)
-
-    install_mozilla_config()
-
-    print(f'{INFO}INFO: installing dconf settings.{RESET}')
-    with args.config.open() as conf_file:
-        config = conf_file.read()
-    run(['dconf', 'load', '-f', '/'], text=True, check=True, input=config)
+    # independent steps run concurrently, e.g. IDE downloads don't have to wait for the package manager
+    # completed steps are journaled, so a rerun with --resume can skip them
+    # refreshing the pip packages has to run the step, even if its requests didn't change
+    force = (*args.force, 'pip') if args.refresh_pip else tuple(args.force)
+    graph = TaskGraph(jobs=args.jobs, keep_going=args.keep_going,
+                      journal=Journal(), resume=args.resume, force=force,
+                      skip=tuple(args.skip))
+    setup_spec.add_tasks(graph, args.verbose)
+    # a bundle is meant for hosts without network access, so the repo only gets what the clone already has
+    graph.add('git', lambda: git_setup(args.stow, offline=bundle is not None),
+              fingerprint=lambda: fingerprint(git_fingerprint(), args.stow, bundle is not None))
+    # stowed packages may contain submodules
+    graph.add('stow', lambda: stow_packages(args.stow, verbose=args.verbose, index=stow_index), depends=('git',),
+              fingerprint=lambda: stow_fingerprint(args.stow))
+    # desktop entries go into directories that stowed packages contain as well
+    graph.add('ides', lambda: install_ides(args.ide, downloader), depends=('stow',),
+              fingerprint=lambda: fingerprint(args.ide))
+    # cleaning the fonts needs fontforge
+    graph.add('fonts', lambda: install_fonts(args.fonts, downloader), depends=('system',),
+              fingerprint=lambda: fingerprint(args.fonts, SCRIPT_DIR / 'clean_nerd_font.py'))
+    # Firefox and Thunderbird need to be installed, before we can configure them
+    graph.add('mozilla', install_mozilla_config, depends=('system',),
+              fingerprint=lambda: fingerprint(ASSET_DIR / 'firefox', ASSET_DIR / 'thunderbird',
+                                              *(clean_path(app_dir) / 'profiles.ini'
+                                                for app_dir, _ in MOZILLA_APPS.values())))
+    # settings of extensions can only be applied once they are installed
+    graph.add('dconf', lambda: load_dconf(args.config, full=args.full_dconf, verbose=args.verbose),
+              depends=('desktop',),
+              fingerprint=lambda: fingerprint(args.config))
+    try:
+        graph.run()
+    finally:
+        profiler.summary()
+        if args.trace is not None:
+            profiler.export(args.trace)
+            print(f'{INFO}INFO: wrote trace to {args.trace}.{RESET}')
 
     print(f'{INFO}INFO: installing espanso.{RESET}')
     espanso_installer = ASSET_DIR / 'install_espanso.sh'
@@ -759,6 +3345,9 @@ def main(args):
 if __name__ == '__main__':
     try:
         args = parse_args()
+        if args.privileged_helper:
+            serve_privileged_requests()
+            exit(0)
         main(args)
     except KeyboardInterrupt:
         print(f'\n\n{INFO}User aborted installation. Bye Bye!{RESET}')
@@ -768,4 +3357,6 @@ if __name__ == '__main__':
         print(f'{ERROR}An error occured. Aborting ...{RESET}')
         exit(1)
     else:
-        print(f'{INFO}Setup complete. Please reboot at your earliest convenience.{RESET}')
+        # --unstow and --dry-run only touch the stowed packages
+        if args.command == 'install' and not (args.unstow or args.dry_run):
+            print(f'{INFO}Setup complete. Please reboot at your earliest convenience.{RESET}')